@@ -12,6 +12,7 @@ from scipy.optimize import curve_fit
 from sklearn.metrics import r2_score
 
 import src.config as config
+import src.graph_analysis as graph_analysis
 from src.preprocessor import Preprocessor, get_config_dict
 import src.utils as utils
 
@@ -203,6 +204,11 @@ class Analyzer(object):
 
         return pd.concat(all_params)
 
+    def extract_graph_stats(self):
+        """Minimal-pair network statistics for real and artificial lexica."""
+        return graph_analysis.graph_stats_for_lexica(self.df_processed, self.artificial_lexica,
+                                                     phon_column=self.phon_column)
+
     def characterize_rank_distribution(self, df, y_column, rank_N=1000):
         """Assign rank to Y and fit power law."""
         new_col = "rank_{x}".format(x=y_column)
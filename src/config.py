@@ -23,6 +23,9 @@ MODEL_INFO = {'n': 4, 'smoothing': .01,
 			  }
 
 ITERATIONS = 10 # number to generate
+SEED = 0 # base seed; artificial lexicon i of the j-th mode is built from (SEED, j, i)
+MODES = ["neutral", "anti_homophones", "anti_homophones_plus"]
+USE_POOL = False # cut neutral lexica as disjoint slices of one candidate pool generated in a single pass
 
 # http://www.iub.edu/~psyling/papers/celex_eug.pdf
 # See pg. 179
@@ -0,0 +1,122 @@
+"""Build artificial lexica for each language and mode across a process pool, with reproducible seeds."""
+
+import os
+import os.path as op
+
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from tqdm import tqdm
+
+import src.config as config
+from src.lexicon_builder import LexiconBuilder
+from src.preprocessor import Preprocessor, get_config_dict
+
+
+ARTIFICIAL_PATH = "data/processed/{language}/artificials/lex{lex}_matched_on_{match}_mode_{mode}_{n}phone.csv"
+POOL_PATH = "data/processed/{language}/artificials/pool_matched_on_{match}_mode_neutral_{n}phone.csv"
+
+# Per-process copy of the builder inputs (model included), set once by init_worker.
+shared = {}
+
+
+def lexicon_seed(base_seed, mode_index, lex):
+    """Seed for artificial lexicon `lex` of the mode_index-th mode.
+
+    Depends only on base_seed, the mode and lex, not on the number of workers. Each mode gets
+    its own streams, so lexica of different modes are generated independently.
+    """
+    return np.random.SeedSequence(base_seed, spawn_key=(mode_index, lex))
+
+
+def init_worker(builder_args, pool=None):
+    """Store the read-only builder inputs (trained model, length distribution, ...) for this process."""
+    shared.clear()
+    shared['builder_args'] = builder_args
+    shared['pool'] = pool
+
+
+def build_one(job):
+    """Build one artificial lexicon and write it to file; returns (lex, mode, path)."""
+    lex, mode_index, mode, base_seed, path = job
+    builder = LexiconBuilder(mode=mode, seed=lexicon_seed(base_seed, mode_index, lex), **shared['builder_args'])
+    if mode == 'neutral' and shared.get('pool') is not None:
+        df_lex = builder.build_lexicon_from_pool(shared['pool'], lex)
+    else:
+        # The length-conditioned sampler only depends on the model and length bins, so reuse it
+        # across lexica built by this process.
+        builder.sampler = shared.get('sampler')
+        df_lex = builder.build_lexicon(lex)
+        shared['sampler'] = builder.sampler
+    df_lex.to_csv(path)
+    return lex, mode, path
+
+
+def generate_lexica(builder_args, N, modes, n, base_seed=0, max_workers=None, use_pool=False):
+    """Build N artificial lexica per mode; each file is written as soon as its lexicon is done.
+
+    builder_args are the LexiconBuilder arguments other than mode and seed. Lexicon i of the
+    j-th mode is seeded from (base_seed, j, i), so its contents do not depend on max_workers.
+    If use_pool, neutral lexica are instead cut as disjoint slices from one pool of N times
+    the length quotas, generated in one pass from base_seed (see LexiconBuilder.generate_pool);
+    lexicon i then depends on base_seed, N and i.
+    Returns the paths written, in (mode, lexicon) order. max_workers=1 builds in this process.
+    """
+    language = builder_args['language']
+    out_dir = op.dirname(ARTIFICIAL_PATH.format(language=language, lex=0, match='', mode='', n=n))
+    if not op.exists(out_dir):
+        print("Creating directory: {dir}".format(dir=out_dir))
+        os.makedirs(out_dir)
+
+    jobs = [(lex, mode_index, mode, base_seed,
+             ARTIFICIAL_PATH.format(language=language, lex=lex, match=builder_args['match_on'], mode=mode, n=n))
+            for mode_index, mode in enumerate(modes) for lex in range(N)]
+
+    pool = None
+    if use_pool and 'neutral' in modes and language != 'japanese':
+        pool_builder = LexiconBuilder(mode='neutral', seed=np.random.SeedSequence(base_seed), **builder_args)
+        pool = pool_builder.generate_pool(num_lexica=N, max_workers=max_workers)
+        pool_path = POOL_PATH.format(language=language, match=builder_args['match_on'], n=n)
+        print("Writing candidate pool to {path}".format(path=pool_path))
+        pool.to_csv(pool_path)
+
+    if max_workers == 1:
+        init_worker(builder_args, pool)
+        for job in tqdm(jobs):
+            build_one(job)
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=init_worker,
+                                 initargs=(builder_args, pool)) as executor:
+            futures = [executor.submit(build_one, job) for job in jobs]
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                lex, mode, path = future.result()
+                print("Wrote {path}".format(path=path))
+    return [job[4] for job in jobs]
+
+
+def main(language, N, modes, base_seed=0, max_workers=None, use_pool=False):
+    """Preprocess a language, then build its artificial lexica."""
+    config_dict = get_config_dict(config, language)
+    preprocessor = Preprocessor(**config_dict)
+    info = preprocessor.preprocess_lexicon()
+    length_dist = preprocessor.obtain_length_distribution(preprocessor.df_processed,
+                                                          match_on=config_dict['match_on'])
+
+    builder_args = {'language': language,
+                    'length_dist': length_dist,
+                    # The compiled model is what the builder samples from, and pickles compactly.
+                    'lm': info['model'].compile(),
+                    'vowels': config_dict['vowels'],
+                    'match_on': config_dict['match_on'],
+                    'rank_distribution': info['homophone_rank_distribution'],
+                    'original_lexicon': info['original_lexicon'],
+                    'surprisals': info['surprisals'],
+                    'phonemes': info['phonemes']}
+
+    return generate_lexica(builder_args, N=N, modes=modes, n=config_dict['n'],
+                           base_seed=base_seed, max_workers=max_workers, use_pool=use_pool)
+
+
+if __name__ == "__main__":
+    main(language=config.LANGUAGE, N=config.ITERATIONS, modes=config.MODES, base_seed=config.SEED,
+         use_pool=config.USE_POOL)
@@ -20,6 +20,10 @@ import time, datetime
 import pickle
 t = time.time()
 import collections
+import bisect
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
 
 
 class LM:
@@ -52,6 +56,68 @@ class LM:
     pass
 
 
+class NgramCounts(object):
+    """N-gram continuation counts for orders 1..n.
+
+    counts[k][context][symbol] is the number of times symbol followed the (k-1)-symbol
+    context, with words padded by '[' on the left and closed by ']'. Counts from
+    different shards of a lexicon can be added together (and subtracted again), and the
+    object pickles, so shards can be counted in separate processes.
+    """
+
+    def __init__(self, n):
+        self.n = n
+        self.counts = {k: collections.defaultdict(collections.Counter) for k in range(1, n + 1)}
+
+    @classmethod
+    def from_wordforms(cls, wordforms, n):
+        """Count n-grams of every order in a single pass over wordforms."""
+        ngram_counts = cls(n)
+        for item in wordforms:
+            padded = "["*(n-1) + item + "]"
+            for k in range(1, n + 1):
+                level = ngram_counts.counts[k]
+                for end in range(n - 1, len(padded)):
+                    level[padded[end-k+1:end]][padded[end]] += 1
+        return ngram_counts
+
+    def units(self):
+        """Return the symbols that can be generated (every symbol seen at order 1)."""
+        return list(self.counts[1][""].keys()) if "" in self.counts[1] else []
+
+    def update(self, other, sign = 1):
+        """Add (or, with sign=-1, subtract) other's counts in place, dropping emptied entries."""
+        for k in range(1, self.n + 1):
+            level = self.counts[k]
+            for context, successors in other.counts[k].items():
+                if sign > 0:
+                    level[context].update(successors)
+                elif context in level:
+                    level[context].subtract(successors)
+                    level[context] = +level[context]
+                    if not level[context]:
+                        del level[context]
+        return self
+
+    def __add__(self, other):
+        return NgramCounts(self.n).update(self).update(other)
+
+    def __sub__(self, other):
+        return NgramCounts(self.n).update(self).update(other, sign=-1)
+
+
+def count_ngrams(wordforms, n, num_shards = 1):
+    """Return NgramCounts for wordforms, counting num_shards shards in separate processes."""
+    wordforms = list(wordforms)
+    if num_shards <= 1:
+        return NgramCounts.from_wordforms(wordforms, n)
+    size = -(-len(wordforms) // num_shards)
+    shards = [wordforms[i:i+size] for i in range(0, len(wordforms), size)]
+    with ProcessPoolExecutor(max_workers=num_shards) as executor:
+        shard_counts = list(executor.map(NgramCounts.from_wordforms, shards, [n]*len(shards)))
+    return sum(shard_counts[1:], shard_counts[0]) if shard_counts else NgramCounts(n)
+
+
 class NgramModel(LM):
     def __init__(self, n, corpus, gen = 0):
         self.n = n
@@ -62,49 +128,58 @@ class NgramModel(LM):
         self.units = []
         self.generation = gen
         self.alpha = collections.defaultdict(lambda: collections.defaultdict(int))
+        self.samplers = {}
+        self.compiled = None
         LM.__init__(self)
 
     def create_model(self, corpus, smoothing = 0):
         """Update cfd using ngrams"""
-        import time
-        unigrams = []
-        for item in corpus:
-            for k in range(1,self.n+1):
-                item_ngrams = nltk.ngrams(["["]*(k-1)  + [i for i in item] + ["]"], k)
-                for ng in item_ngrams:
-                    self.cfd[k]["".join(ng[:-1])][ng[-1]] += 1.0 #* float(f)
-                    unigrams += [ng[-1]]
-        U = len(set(unigrams))
+        self.fit_counts(NgramCounts.from_wordforms(corpus, self.n), smoothing)
+
+    def fit_counts(self, counts, smoothing = 0):
+        """Set cfd, cpd and alpha from NgramCounts, normalizing each context once."""
         # Create set of unique phonemes
-        self.units = list(set(unigrams))
+        self.units = counts.units()
+        U = len(self.units)
         self.smoothing = smoothing
-        for k in self.cfd.keys():
-            for i in self.cfd[k].keys():
+        self.samplers = {}
+        self.compiled = None
+        for k in range(1, self.n + 1):
+            for i, successors in counts.counts[k].items():
+                total = float(sum(successors.values()) + smoothing*U)
                 pbak = 0
-                for j in self.cfd[k][i].keys():
-                    self.cpd[k][i][j] = (self.cfd[k][i][j] + smoothing) / float(sum(self.cfd[k][i].values()) + smoothing*U)
+                for j, c in successors.items():
+                    self.cfd[k][i][j] = float(c)
+                    self.cpd[k][i][j] = (c + smoothing) / total
                     pbak += self.cpd[k-1][i[1:]][j]
                 if self.smoothing:
-                    self.alpha[k][i] = (1 - sum(self.cpd[k][i].values())) / float(1 - pbak) 
-        LM.create_model(self, corpus, smoothing)
+                    self.alpha[k][i] = (1 - sum(self.cpd[k][i].values())) / float(1 - pbak)
+        LM.create_model(self, counts, smoothing)
+
+    def compile(self):
+        """Return an array-backed copy of the model with the backoff resolved for every context."""
+        return CompiledNgramModel.from_model(self)
+
+    def sampler(self, context):
+        """Return (sorted units, cumulative probabilities) for context, built on first use."""
+        if context not in self.samplers:
+            if self.smoothing:
+                possibles = sorted(self.units)
+                pd = [self.backoff(self.n, context, u) for u in possibles]
+            else:
+                possibles = sorted(self.cpd[self.n][context].keys())
+                pd = [self.cpd[self.n][context][u] for u in possibles]
+            self.samplers[context] = (possibles, list(itertools.accumulate(pd)))
+        return self.samplers[context]
 
     def multichooser(self, context):
         """ Return random choice from multinomial cfd. """
         context = "".join(context)
-        cumprob = 0
         rand = random.random()
-        pd  = collections.defaultdict(int)
-        if self.smoothing:
-            for u in self.units:
-                pd[u] = self.backoff(self.n, context, u)
-            possibles = list(self.units)
-        else:
-            possibles = self.cpd[self.n][context].keys()
-            pd = self.cpd[self.n][context]
-        possibles.sort()
-        for possible in possibles:
-            cumprob += pd[possible]
-            if cumprob > rand: return possible
+        possibles, cumprobs = self.sampler(context)
+        i = bisect.bisect_right(cumprobs, rand)
+        if i < len(possibles):
+            return possibles[i]
         return
 	    
     def generate(self, ngen = 1):
@@ -112,7 +187,12 @@ class NgramModel(LM):
         LM.generate(self, ngen)
         words = [self.generate_one(self.n) for xx in range(ngen)]
         return words
-        
+
+    def generate_batch(self, ngen, rng = None):
+        """Generate ngen words and their log probabilities; see CompiledNgramModel.generate_batch."""
+        if self.compiled is None:
+            self.compiled = self.compile()
+        return self.compiled.generate_batch(ngen, rng)
         
     def generate_one(self, n):
         """Generate one word from ngram model."""
@@ -145,6 +225,18 @@ class NgramModel(LM):
             fifo.append(ch)
         return len(word), oov, p
 
+    def evaluate_many(self, wordforms):
+        """Score many wordforms at once; see CompiledNgramModel.evaluate_many."""
+        if self.compiled is None:
+            self.compiled = self.compile()
+        return self.compiled.evaluate_many(wordforms)
+
+    def save(self, path):
+        """Save the compiled model to path; reload it with CompiledNgramModel.load."""
+        if self.compiled is None:
+            self.compiled = self.compile()
+        self.compiled.save(path)
+
     def backoff(self, n, h, c):
         if c in self.cpd[n][h].keys() and n > 0:#seen ngram
             return self.cpd[n][h][c]
@@ -156,14 +248,530 @@ class NgramModel(LM):
             return self.alpha[n][h] * self.cpd[n-1][h[1:]][c]
         else:
             return 0
-            
 
 
+def normalize_rows(table):
+    """Scale each row of table to sum to 1 (rows of zeros stay zero)."""
+    totals = table.sum(axis=1, keepdims=True)
+    return np.divide(table, totals, out=np.zeros_like(table), where=totals > 0)
+
+
+class CompiledNgramModel(LM):
+    """NgramModel compiled into NumPy tables.
+
+    Every context observed in training becomes an integer state. `transitions[s, c]` is the
+    state reached after emitting unit `c` in state `s` (the longest observed suffix of the new
+    context), and `probs[s, c]` is the fully backed-off probability NgramModel.backoff would
+    return for `c` in that context. The last column of both tables is reserved for
+    out-of-vocabulary symbols: probability 0, and a transition back to the empty context.
+
+    Words are drawn from `sample_probs`, the distribution NgramModel.sampler draws from. With
+    smoothing this is `probs` itself. Without smoothing, `probs` rows are not distributions
+    (alpha is 1, so backed-off mass is added on top of the observed probabilities), and
+    `sample_probs` keeps only the units observed after each context, renormalized. Either
+    way multichooser makes the same draw as NgramModel.multichooser for the same random seed.
+    """
+
+    # Bump whenever the tables saved by save() change meaning or layout.
+    FORMAT_VERSION = 2
+
+    def __init__(self, n, smoothing, units, contexts, transitions, probs, sample_probs=None):
+        self.n = n
+        self.smoothing = smoothing
+        self.units = list(units)
+        self.contexts = list(contexts)
+        self.transitions = transitions
+        self.probs = probs
+        self.sample_probs = probs if sample_probs is None else sample_probs
+        self.unit_index = {u: i for i, u in enumerate(self.units)}
+        self.context_index = {h: i for i, h in enumerate(self.contexts)}
+        self.cumprobs = {}
+        self.cumtable = None
+        self.oov_id = len(self.units)
+        self.end_id = self.unit_index.get("]", self.oov_id)
+        self.start = self.context_id("["*(self.n - 1))
+        LM.__init__(self)
+        self.has_model = True
+
+    @classmethod
+    def from_model(cls, lm):
+        """Compile a trained NgramModel."""
+        units = sorted(lm.units)
+        unit_index = {u: i for i, u in enumerate(units)}
+        U = len(units)
+
+        # Observed contexts, shortest first; the empty (unigram) context is state 0.
+        levels = [sorted(lm.cfd[k].keys()) if k in lm.cfd else [] for k in range(1, lm.n + 1)]
+        contexts = [h for level in levels for h in level]
+        index = {h: i for i, h in enumerate(contexts)}
+
+        transitions = np.zeros((len(contexts), U + 1), dtype=np.int32)
+        probs = np.zeros((len(contexts), U + 1))
+        observed = np.zeros((len(contexts), U + 1))
+        for k, level in enumerate(levels, start=1):
+            # Extending a shorter context by one unit lands on an observed context.
+            # (Padding-only extensions are never emitted, so they need no transition.)
+            for h in level:
+                if h and h[-1] in unit_index:
+                    transitions[index[h[:-1]], unit_index[h[-1]]] = index[h]
+            for h in level:
+                s = index[h]
+                alpha = lm.alpha[k][h] if h in lm.alpha[k] else 1.0
+                if h:
+                    link = index[h[1:]]
+                    transitions[s] = transitions[link]
+                    probs[s] = alpha * probs[link]
+                for c, p in lm.cpd[k][h].items():
+                    probs[s, unit_index[c]] = p
+                    observed[s, unit_index[c]] = p
+        sample_probs = None if lm.smoothing else normalize_rows(observed)
+        return cls(lm.n, lm.smoothing, units, contexts, transitions, probs, sample_probs)
+
+    def save(self, path):
+        """Save the model tables to an uncompressed .npz file."""
+        np.savez(path,
+                 format_version=np.array(self.FORMAT_VERSION),
+                 n=np.array(self.n),
+                 smoothing=np.array(self.smoothing, dtype=float),
+                 units=np.array(self.units, dtype=str),
+                 contexts=np.array(self.contexts, dtype=str),
+                 transitions=self.transitions,
+                 probs=self.probs,
+                 sample_probs=self.sample_probs)
+
+    @classmethod
+    def load(cls, path):
+        """Load a model written by save(), refusing files from another format version."""
+        with np.load(path, allow_pickle=False) as data:
+            version = int(data['format_version']) if 'format_version' in data else None
+            if version != cls.FORMAT_VERSION:
+                raise ValueError("{path} has model format version {v}, expected {e}; re-save it from a trained NgramModel.".format(
+                    path=path, v=version, e=cls.FORMAT_VERSION))
+            return cls(int(data['n']), float(data['smoothing']), data['units'].tolist(), data['contexts'].tolist(),
+                       data['transitions'], data['probs'], data['sample_probs'])
+
+    def context_id(self, context):
+        """Return the state of the longest observed suffix of context."""
+        context = "".join(context)
+        for m in range(min(len(context), self.n - 1), 0, -1):
+            s = self.context_index.get(context[len(context) - m:])
+            if s is not None:
+                return s
+        return 0
+
+    def multichooser(self, context):
+        """ Return random choice from multinomial cfd. """
+        state = context if isinstance(context, (int, np.integer)) else self.context_id(context)
+        rand = random.random()
+        if state not in self.cumprobs:
+            self.cumprobs[state] = np.cumsum(self.sample_probs[state, :self.oov_id])
+        i = self.cumprobs[state].searchsorted(rand, side="right")
+        if i < len(self.units):
+            return self.units[i]
+        return
+
+    def generate(self, ngen = 1):
+        """Generate as many words as specified by ngen"""
+        LM.generate(self, ngen)
+        words = [self.generate_one(self.n) for xx in range(ngen)]
+        return words
+
+    def generate_batch(self, ngen, rng = None):
+        """Generate ngen words in lockstep.
+
+        rng is a numpy Generator or a seed for one, so a given seed always yields the same
+        stream. Returns the words and their log10 probabilities (as evaluate() would
+        compute them). A word whose draw falls in the residual mass of a context that does
+        not sum to 1 is restarted, as generate_one restarts on a stray '['.
+        """
+        LM.generate(self, ngen)
+        rng = np.random.default_rng(rng)
+        if self.cumtable is None:
+            self.cumtable = np.cumsum(self.sample_probs[:, :self.oov_id], axis=1)
+
+        symbols = np.zeros((ngen, 16), dtype=np.int32)
+        lengths = np.zeros(ngen, dtype=np.int64)
+        log_probs = np.zeros(ngen)
+        states = np.full(ngen, self.start, dtype=np.int32)
+        active = np.arange(ngen)
+        while len(active):
+            # Index of the first unit whose cumulative probability exceeds the draw.
+            rand = rng.random(len(active))
+            choice = (self.cumtable[states[active]] <= rand[:, None]).sum(axis=1)
+
+            restart = choice == self.oov_id
+            if restart.any():
+                lost = active[restart]
+                states[lost] = self.start
+                lengths[lost] = 0
+                log_probs[lost] = 0
+                active, choice = active[~restart], choice[~restart]
+
+            log_probs[active] += np.log(self.probs[states[active], choice]) / log(10)
+            states[active] = self.transitions[states[active], choice]
+
+            ended = choice == self.end_id
+            active, choice = active[~ended], choice[~ended]
+            if len(active) and lengths[active].max() == symbols.shape[1]:
+                symbols = np.hstack([symbols, np.zeros_like(symbols)])
+            symbols[active, lengths[active]] = choice
+            lengths[active] += 1
+
+        words = ["".join(self.units[c] for c in row[:l]) for row, l in zip(symbols, lengths)]
+        return words, log_probs
+
+    def generate_one(self, n):
+        """Generate one word from the compiled model."""
+        word = []
+        state = self.start
+        while True:
+            ch = self.multichooser(state)
+            if ch == "]":
+                break
+            word.append(ch)
+            state = self.transitions[state, self.unit_index[ch]]
+        return "".join(word)
+
+    def evaluate(self, word):
+        """ get the log probability of generating a given word under the language model """
+        LM.evaluate(self, word)
+        p = 0
+        oov = 0
+        symbols = [self.unit_index.get(ch, self.oov_id) for ch in word] + [self.end_id]
+        state = self.start
+        for c in symbols:
+            pbak = self.probs[state, c]
+            if pbak != 0:
+                p += log(pbak, 10)
+            else:
+                oov += 1
+            state = self.transitions[state, c]
+        return len(symbols), oov, p
+
+    def evaluate_many(self, wordforms):
+        """Score a sequence of wordforms in one vectorized pass.
+
+        Each distinct form is scored once. Returns three arrays aligned with wordforms:
+        length (including the end symbol), number of OOV symbols and log10 probability,
+        i.e. the columns of evaluate().
+        """
+        LM.evaluate(self, wordforms)
+        forms, inverse = np.unique(np.asarray(wordforms, dtype=str), return_inverse=True)
+        inverse = inverse.reshape(-1)
+        lengths = np.fromiter(map(len, forms), dtype=np.int64, count=len(forms))
+
+        # Map every character to its unit id through the sorted code points of the alphabet.
+        codes = np.frombuffer("".join(forms).encode("utf-32-le"), dtype=np.uint32)
+        unit_codes = np.array([ord(u) for u in self.units], dtype=np.uint32)
+        order = np.argsort(unit_codes)
+        pos = np.minimum(np.searchsorted(unit_codes[order], codes), len(unit_codes) - 1)
+        known = unit_codes[order][pos] == codes
+        ids = np.where(known, order[pos], self.oov_id)
+
+        # Pad into a matrix (longest forms first), closing every row with the end symbol.
+        by_length = np.argsort(-lengths, kind="stable")
+        width = lengths.max() + 1 if len(forms) else 1
+        symbols = np.full((len(forms), width), self.end_id, dtype=np.int64)
+        starts = np.cumsum(lengths) - lengths
+        rows = np.repeat(np.arange(len(forms)), lengths)
+        cols = np.arange(len(ids)) - np.repeat(starts, lengths)
+        symbols[rows, cols] = ids
+        symbols = symbols[by_length]
+        sorted_lengths = lengths[by_length]
+
+        log_probs = np.zeros(len(forms))
+        oovs = np.zeros(len(forms), dtype=np.int64)
+        states = np.full(len(forms), self.start, dtype=np.int64)
+        for t in range(width):
+            # Rows are sorted by length, so the forms still being scored form a prefix.
+            k = np.searchsorted(-sorted_lengths, -t, side="right")
+            c = symbols[:k, t]
+            p = self.probs[states[:k], c]
+            seen = p != 0
+            log_probs[:k][seen] += np.log(p[seen]) / log(10)
+            oovs[:k] += ~seen
+            states[:k] = self.transitions[states[:k], c]
+
+        unsorted = np.empty_like(by_length)
+        unsorted[by_length] = np.arange(len(forms))
+        return ((lengths + 1)[inverse], oovs[unsorted][inverse], log_probs[unsorted][inverse])
+
+
+class NgramTable(object):
+    """NgramCounts laid out as flat arrays over a fixed set of contexts and units.
+
+    Each (context, unit) pair seen in the counts is an entry. A count vector over the
+    entries (e.g. the full lexicon's counts minus one fold's) can be compiled straight into a
+    CompiledNgramModel, matching NgramModel.fit_counts on the same counts up to
+    floating-point summation order. Contexts or units whose counts drop to zero behave as
+    unseen.
+    """
+
+    def __init__(self, counts):
+        self.n = counts.n
+        self.units = sorted(counts.units())
+        unit_index = {u: i for i, u in enumerate(self.units)}
+
+        levels = [sorted(counts.counts[k].keys()) for k in range(1, self.n + 1)]
+        self.contexts = [h for level in levels for h in level]
+        context_index = {h: i for i, h in enumerate(self.contexts)}
+        self.level_bounds = np.cumsum([0] + [len(level) for level in levels])
+        self.links = np.array([context_index[h[1:]] if h else -1 for h in self.contexts], dtype=np.int64)
+
+        self.entry_index = {}
+        entry_context, entry_unit = [], []
+        for level in levels:
+            for h in level:
+                for u in counts.counts[len(h) + 1][h]:
+                    self.entry_index[(h, u)] = len(entry_context)
+                    entry_context.append(context_index[h])
+                    entry_unit.append(unit_index[u])
+        self.entry_context = np.array(entry_context, dtype=np.int64)
+        self.entry_unit = np.array(entry_unit, dtype=np.int64)
+        self.level_entries = np.searchsorted(self.entry_context, self.level_bounds)
+        # The same unit after the context with its first symbol dropped (one order lower).
+        self.entry_backoff = np.array([self.entry_index[(self.contexts[c][1:], self.units[u])] if self.contexts[c] else -1
+                                       for c, u in zip(entry_context, entry_unit)], dtype=np.int64)
+
+        # Contexts reached by emitting a unit: (parent context, unit, child context).
+        children = [(context_index[h[:-1]], unit_index[h[-1]], context_index[h])
+                    for h in self.contexts if h and h[-1] in unit_index]
+        self.children = np.array(children, dtype=np.int64).reshape(-1, 3)
 
+    def __getstate__(self):
+        # The (context, unit) -> entry dict is only needed to map counts onto the table;
+        # leave it out when the table is shipped to worker processes.
+        state = self.__dict__.copy()
+        state['entry_index'] = None
+        return state
+
+    def entry_counts(self, counts):
+        """Return counts as a vector over the table's entries."""
+        if self.entry_index is None:
+            self.entry_index = {(self.contexts[c], self.units[u]): e
+                                for e, (c, u) in enumerate(zip(self.entry_context, self.entry_unit))}
+        vector = np.zeros(len(self.entry_context))
+        for k in range(1, self.n + 1):
+            for h, successors in counts.counts[k].items():
+                for u, c in successors.items():
+                    vector[self.entry_index[(h, u)]] += c
+        return vector
+
+    def compile(self, entry_counts, smoothing = 0):
+        """Fit and compile a model from a count vector over the table's entries."""
+        S, U = len(self.contexts), len(self.units)
+        observed = entry_counts > 0
+        units_seen = int(observed[self.level_entries[0]:self.level_entries[1]].sum())
+
+        totals = np.bincount(self.entry_context, weights=entry_counts, minlength=S)
+        cpd = np.divide(entry_counts + smoothing, totals[self.entry_context] + smoothing*units_seen,
+                        out=np.zeros(len(entry_counts)), where=observed)
+        cpd_sums = np.bincount(self.entry_context, weights=cpd, minlength=S)
+        backed_off = np.where(observed & (self.entry_backoff >= 0), cpd[self.entry_backoff], 0)
+        pbak = np.bincount(self.entry_context, weights=backed_off, minlength=S)
+        alpha = np.ones(S)
+        if smoothing:
+            np.divide(1 - cpd_sums, 1 - pbak, out=alpha, where=pbak < 1)
+
+        context_seen = totals > 0
+        child_seen = context_seen[self.children[:, 2]]
+        transitions = np.zeros((S, U + 1), dtype=np.int32)
+        probs = np.zeros((S, U + 1))
+        observed_probs = np.zeros((S, U + 1))
+        for k in range(self.n):
+            lo, hi = self.level_bounds[k], self.level_bounds[k + 1]
+            children = self.children[child_seen & (self.children[:, 2] >= lo) & (self.children[:, 2] < hi)]
+            transitions[children[:, 0], children[:, 1]] = children[:, 2]
+            if k:
+                links = self.links[lo:hi]
+                transitions[lo:hi] = transitions[links]
+                probs[lo:hi] = alpha[lo:hi, None] * probs[links]
+            entries = np.arange(self.level_entries[k], self.level_entries[k + 1])
+            entries = entries[observed[entries]]
+            probs[self.entry_context[entries], self.entry_unit[entries]] = cpd[entries]
+            observed_probs[self.entry_context[entries], self.entry_unit[entries]] = cpd[entries]
+
+        sample_probs = None if smoothing else normalize_rows(observed_probs)
+        return CompiledNgramModel(self.n, smoothing, self.units, self.contexts, transitions, probs, sample_probs)
+
+
+class PhonotacticAutomaton(object):
+    """Finite-state well-formedness constraint on words.
+
+    Defined by a start state, step(state, unit) -> next state (None once the word can no
+    longer be well-formed) and accepts(state), whether a word may end there. compile()
+    explores the states reachable over a model's units and minimizes them into integer
+    tables, which LengthConditionedSampler composes with the n-gram states.
+    """
+
+    def __init__(self, start, step, accepts):
+        self.start = start
+        self.step = step
+        self.accepts = accepts
+
+    @classmethod
+    def vowel_required(cls, vowels):
+        """Words must contain at least one vowel."""
+        return cls(False, lambda has_vowel, unit: has_vowel or unit in vowels, lambda has_vowel: has_vowel)
+
+    def __and__(self, other):
+        """Automaton accepting the words both automata accept."""
+        def step(state, unit):
+            a, b = self.step(state[0], unit), other.step(state[1], unit)
+            return None if a is None or b is None else (a, b)
+        return PhonotacticAutomaton((self.start, other.start), step,
+                                    lambda state: self.accepts(state[0]) and other.accepts(state[1]))
+
+    def accepts_word(self, word):
+        """Whether word satisfies the constraint."""
+        state = self.start
+        for unit in word:
+            state = self.step(state, unit)
+            if state is None:
+                return False
+        return self.accepts(state)
+
+    def compile(self, units):
+        """Return (transitions, accepting) tables over units, with state 0 the start.
+
+        Dead ends go to a rejecting sink, and equivalent states are merged (Moore's
+        partition refinement) to keep the product with the n-gram states small.
+        """
+        states, index, rows = [self.start], {self.start: 0}, []
+        while len(rows) < len(states):
+            row = []
+            for unit in units:
+                state = states[len(rows)]
+                target = None if state is None else self.step(state, unit)
+                if target not in index:
+                    index[target] = len(states)
+                    states.append(target)
+                row.append(index[target])
+            rows.append(row)
+        transitions = np.array(rows, dtype=np.int64).reshape(len(states), len(units))
+        accepting = np.array([state is not None and bool(self.accepts(state)) for state in states])
+
+        blocks = accepting.astype(np.int64)
+        while True:
+            signatures = np.column_stack([blocks, blocks[transitions]])
+            refined = np.unique(signatures, axis=0, return_inverse=True)[1].reshape(-1)
+            if len(np.unique(refined)) == len(np.unique(blocks)):
+                break
+            blocks = refined
+        # Renumber so that the start state's block is 0.
+        start = blocks[0]
+        blocks = np.where(blocks == 0, start, np.where(blocks == start, 0, blocks))
+        first = np.unique(blocks, return_index=True)[1]
+        return blocks[transitions[first]], accepting[first]
+
+
+class LengthConditionedSampler(object):
+    """Sample words from a compiled model conditioned on their exact length.
+
+    Length is counted in phones (match_on='phones') or in vowels, the syllable estimate of
+    utils.count_syllables (match_on='sylls'). Backward weights give, for every context
+    state and automaton state, the probability of finishing the word with exactly r more
+    length units and being accepted by the automaton, so each draw comes from the model's
+    distribution restricted to well-formed words of the target length. By default the
+    automaton only requires a vowel, as LexiconBuilder.satisfies_criteria does.
+    """
+
+    def __init__(self, model, vowels, match_on='sylls', max_length=20, automaton=None):
+        if not isinstance(model, CompiledNgramModel):
+            model = model.compile()
+        if automaton is None:
+            automaton = PhonotacticAutomaton.vowel_required(vowels)
+        self.model = model
+        self.match_on = match_on
+        self.max_length = max_length
+
+        U = len(model.units)
+        # Draw from the model's sampling distribution; report log probabilities from its scores.
+        self.probs = model.sample_probs[:, :U]
+        self.next_states = model.transitions[:, :U]
+        self.is_vowel = np.array([u in vowels for u in model.units])
+        # Length units used by each symbol; ']' ends the word instead.
+        self.cost = np.ones(U, dtype=np.int64) if match_on == 'phones' else self.is_vowel.astype(np.int64)
+        self.cost[model.end_id] = 0
+        self.emits = np.arange(U) != model.end_id
+        self.automaton_transitions, self.accepting = automaton.compile(model.units)
+
+        self.weights = self.backward()
+
+    def backward(self):
+        """Return weights[q, r, s]: P(finish from state s, automaton state q, with exactly r more length units).
+
+        In 'sylls' mode consonants cost nothing, so each length is a fixed point over
+        consonant steps, solved by iteration.
+        """
+        Q, S = len(self.accepting), len(self.probs)
+        weights = np.zeros((Q, self.max_length + 1, S))
+        free = self.emits & (self.cost == 0)
+        paid = self.emits & (self.cost == 1)
+        free_probs, free_states, free_next = self.probs[:, free], self.next_states[:, free], self.automaton_transitions[:, free]
+        paid_probs, paid_states, paid_next = self.probs[:, paid], self.next_states[:, paid], self.automaton_transitions[:, paid]
+        end_probs = self.model.sample_probs[:, self.model.end_id]
+        for r in range(self.max_length + 1):
+            if r == 0:
+                base = self.accepting[:, None] * end_probs[None, :]
+            else:
+                base = np.stack([(paid_probs * weights[paid_next[q][None, :], r - 1, paid_states]).sum(axis=1)
+                                 for q in range(Q)])
+            x = base
+            if free.any():
+                for _ in range(10000):
+                    x_new = base + np.stack([(free_probs * x[free_next[q][None, :], free_states]).sum(axis=1)
+                                             for q in range(Q)])
+                    if np.allclose(x_new, x, rtol=1e-13, atol=0):
+                        break
+                    x = x_new
+                x = x_new
+            weights[:, r] = x
+        return weights
 
+    def length_probabilities(self):
+        """Return the probability that an unconstrained word is accepted and has each length 0..max_length."""
+        return self.weights[0, :, self.model.start]
 
+    def generate_batch(self, lengths, rng = None):
+        """Generate one word of each requested length, with log10 probabilities under the model."""
+        rng = np.random.default_rng(rng)
+        lengths = np.asarray(lengths, dtype=np.int64)
+        if (self.length_probabilities()[lengths] == 0).any():
+            raise ValueError("The model cannot generate words of some requested lengths.")
+        k = len(lengths)
+        end_id = self.model.end_id
 
+        symbols = np.zeros((k, 16), dtype=np.int32)
+        sizes = np.zeros(k, dtype=np.int64)
+        log_probs = np.zeros(k)
+        states = np.full(k, self.model.start, dtype=np.int64)
+        remaining = lengths.copy()
+        automaton_states = np.zeros(k, dtype=np.int64)
+        active = np.arange(k)
+        while len(active):
+            s, r, q = states[active], remaining[active], automaton_states[active]
+            # Weight of each next symbol: its probability times the chance of finishing on target.
+            after_r = r[:, None] - self.cost[None, :]
+            weights = self.probs[s] * self.weights[self.automaton_transitions[q], np.maximum(after_r, 0), self.next_states[s]]
+            weights[after_r < 0] = 0
+            weights[:, end_id] = self.probs[s, end_id] * (r == 0) * self.accepting[q]
 
+            cum = np.cumsum(weights, axis=1)
+            rand = rng.random(len(active)) * cum[:, -1]
+            choice = np.minimum((cum <= rand[:, None]).sum(axis=1), len(self.model.units) - 1)
 
+            log_probs[active] += np.log(self.model.probs[s, choice]) / log(10)
+            states[active] = self.next_states[s, choice]
+            remaining[active] -= self.cost[choice]
+            automaton_states[active] = self.automaton_transitions[q, choice]
 
+            ended = choice == end_id
+            active, choice = active[~ended], choice[~ended]
+            if len(active) and sizes[active].max() == symbols.shape[1]:
+                symbols = np.hstack([symbols, np.zeros_like(symbols)])
+            symbols[active, sizes[active]] = choice
+            sizes[active] += 1
 
+        words = ["".join(self.model.units[c] for c in row[:l]) for row, l in zip(symbols, sizes)]
+        return words, log_probs
@@ -0,0 +1,127 @@
+"""Graph statistics over minimal-pair networks, computed on scipy.sparse adjacency matrices.
+
+Each unique wordform is a node; two wordforms are connected if they form a minimal pair
+(edit distance 1). All statistics are vectorized over the adjacency matrix, so they scale
+to lexica with hundreds of thousands of wordforms."""
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+from scipy.sparse import csgraph
+
+from src.lexicon import NeighborIndex
+
+
+def minimal_pair_graph(wordforms):
+    """Return (unique wordforms, symmetric CSR adjacency matrix) for the minimal-pair network."""
+    index = NeighborIndex()
+    sources, targets = [], []
+    for w in wordforms:
+        if w in index.ids:
+            continue
+        neighbor_ids = index.query(w)
+        node_id = index.add(w)
+        sources.extend([node_id] * len(neighbor_ids))
+        targets.extend(neighbor_ids)
+    return index.forms, symmetric_adjacency(sources, targets, len(index))
+
+
+def symmetric_adjacency(sources, targets, num_nodes):
+    """Build a symmetric 0/1 CSR matrix from a list of undirected edges."""
+    sources = np.asarray(sources, dtype=np.int64)
+    targets = np.asarray(targets, dtype=np.int64)
+    rows = np.concatenate([sources, targets])
+    cols = np.concatenate([targets, sources])
+    adjacency = sp.csr_matrix((np.ones(len(rows), dtype=np.int64), (rows, cols)),
+                              shape=(num_nodes, num_nodes))
+    adjacency.sum_duplicates()
+    adjacency.data[:] = 1
+    return adjacency
+
+
+def degrees(adjacency):
+    """Number of neighbors of each node."""
+    return np.diff(adjacency.indptr)
+
+
+def degree_distribution(adjacency):
+    """Number of nodes with each degree, indexed by degree 0..max."""
+    counts = np.bincount(degrees(adjacency))
+    return pd.Series(counts, index=pd.RangeIndex(len(counts), name='degree'), name='num_nodes')
+
+
+def component_sizes(adjacency):
+    """Return (component label of each node, size of each component)."""
+    _, labels = csgraph.connected_components(adjacency, directed=False)
+    return labels, np.bincount(labels)
+
+
+def triangles(adjacency):
+    """Number of triangles each node participates in."""
+    paths = adjacency @ adjacency
+    return np.asarray(paths.multiply(adjacency).sum(axis=1)).ravel() // 2
+
+
+def clustering_coefficients(adjacency):
+    """Local clustering coefficient of each node (0 for nodes with fewer than two neighbors)."""
+    k = degrees(adjacency).astype(float)
+    possible = k * (k - 1) / 2
+    coefficients = np.zeros(len(k))
+    np.divide(triangles(adjacency), possible, out=coefficients, where=possible > 0)
+    return coefficients
+
+
+def transitivity(adjacency):
+    """Global clustering coefficient: 3 * triangles / connected triples."""
+    k = degrees(adjacency).astype(float)
+    triples = (k * (k - 1) / 2).sum()
+    return triangles(adjacency).sum() / triples if triples > 0 else 0.0
+
+
+def degree_assortativity(adjacency):
+    """Pearson correlation between the degrees at either end of each edge."""
+    k = degrees(adjacency)
+    coo = adjacency.tocoo()
+    if coo.nnz == 0:
+        return np.nan
+    x, y = k[coo.row].astype(float), k[coo.col].astype(float)
+    if x.std() == 0:
+        return np.nan
+    return np.corrcoef(x, y)[0, 1]
+
+
+def get_graph_stats(adjacency):
+    """Return summary statistics of a minimal-pair network."""
+    num_nodes = adjacency.shape[0]
+    k = degrees(adjacency)
+    _, sizes = component_sizes(adjacency)
+    giant = sizes.max() if len(sizes) > 0 else 0
+    return {'num_nodes': num_nodes,
+            'num_edges': adjacency.nnz // 2,
+            'mean_degree': k.mean() if num_nodes else 0.0,
+            'max_degree': k.max() if num_nodes else 0,
+            'isolates': int((k == 0).sum()),
+            'num_components': len(sizes),
+            'giant_component_size': giant,
+            'giant_component_proportion': giant / num_nodes if num_nodes else 0.0,
+            'mean_clustering': clustering_coefficients(adjacency).mean() if num_nodes else 0.0,
+            'transitivity': transitivity(adjacency),
+            'degree_assortativity': degree_assortativity(adjacency)}
+
+
+def graph_stats_for_lexicon(df_lex, phon_column="PhonDISC"):
+    """Build the minimal-pair network of a lexicon's unique wordforms and summarize it."""
+    _, adjacency = minimal_pair_graph(df_lex[phon_column].dropna().values)
+    return get_graph_stats(adjacency)
+
+
+def graph_stats_for_lexica(df_real, artificial_lexica, phon_column="PhonDISC", art_column="word"):
+    """Graph statistics for the real lexicon and each artificial lexicon, one row per lexicon."""
+    rows = [dict(graph_stats_for_lexicon(df_real, phon_column=phon_column), mode='real', lexicon=0)]
+    for df_lex in artificial_lexica:
+        stats = graph_stats_for_lexicon(df_lex, phon_column=art_column)
+        stats['mode'] = df_lex['mode'].values[0]
+        stats['lexicon'] = df_lex['lexicon'].values[0]
+        rows.append(stats)
+    return pd.DataFrame(rows)
@@ -1,13 +1,18 @@
 """Class for representing lexicon as a graph structure. Each wordform is a node, and each minimal pair
 is connected via an edge."""
 
-import re
+from array import array
+from collections import defaultdict
 
-from src.minimal_pairs import generate_mp_regex
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
 
 
 class Wordform(object):
 
+	__slots__ = ('wordform', 'surprisal', 'num_sylls', 'num_phones', 'neighbors', 'homophones')
+
 	def __init__(self, wordform, surprisal, num_sylls):
 		self.wordform = wordform
 		self.surprisal = surprisal
@@ -16,7 +21,7 @@ class Wordform(object):
 
 		self.neighbors = []
 		self.homophones = 0
-		
+
 
 	def __repr__(self):
 		return self.wordform
@@ -46,28 +51,156 @@ class Edge(object):
 		return self.w1 == target.w1 and self.w2 == target.w2
 
 
+class NeighborIndex(object):
+	"""Index of wordforms by their single-wildcard and single-deletion variants.
+
+	Finds the indexed forms one edit (substitution, insertion or deletion) away from any
+	query in O(L) bucket lookups. This is the neighbor set generate_mp_regex matches, for
+	forms free of regex metacharacters (which the phonetic remappings take care of).
+	"""
+
+	def __init__(self):
+		self.forms = []
+		self.ids = {}
+		# (position, form without that position) -> ids of forms of the same length
+		self.substitutions = defaultdict(list)
+		# form with one position deleted -> ids of the (one longer) forms it came from
+		self.deletions = defaultdict(list)
+
+	def __len__(self):
+		return len(self.forms)
+
+	def add(self, form):
+		"""Index form and return its id; ids count up from 0 in insertion order."""
+		if form in self.ids:
+			return self.ids[form]
+		form_id = len(self.forms)
+		self.forms.append(form)
+		self.ids[form] = form_id
+		for key in self.substitution_keys(form):
+			self.substitutions[key].append(form_id)
+		for variant in self.deletion_variants(form):
+			self.deletions[variant].append(form_id)
+		return form_id
+
+	def query(self, form):
+		"""Return the ids of indexed forms one edit away from form, in insertion order."""
+		found = set()
+		for key in self.substitution_keys(form):
+			found.update(self.substitutions.get(key, ()))
+		found.update(self.deletions.get(form, ()))
+		for variant in self.deletion_variants(form):
+			if variant in self.ids:
+				found.add(self.ids[variant])
+		found.discard(self.ids.get(form))
+		return sorted(found)
+
+	def substitution_keys(self, form):
+		return [(i, form[:i] + form[i+1:]) for i in range(len(form))]
+
+	def deletion_variants(self, form):
+		return set(form[:i] + form[i+1:] for i in range(len(form)))
+
+
+class LexiconTrie(object):
+	"""Trie over a lexicon's wordforms for ad hoc neighbor queries of arbitrary strings.
+
+	Built once per lexicon (and picklable), it finds the forms within edit distance k of a
+	query by walking the trie with one Levenshtein row per node, pruning branches whose row
+	minimum exceeds k, so a query only visits the prefixes that can still match.
+	"""
+
+	def __init__(self, wordforms=()):
+		self.root = {}
+		self.size = 0
+		for form in wordforms:
+			self.add(form)
+
+	@classmethod
+	def from_lexicon(cls, df_lex, phon_column="PhonDISC"):
+		"""Build a trie from the wordforms in a lexicon dataframe."""
+		return cls(df_lex[phon_column].dropna().values)
+
+	def __len__(self):
+		return self.size
+
+	def __contains__(self, form):
+		node = self.root
+		for char in form:
+			if char not in node:
+				return False
+			node = node[char]
+		return None in node
+
+	def add(self, form):
+		"""Add form to the trie (the None key of a node holds the form ending there)."""
+		node = self.root
+		for char in form:
+			node = node.setdefault(char, {})
+		if None not in node:
+			node[None] = form
+			self.size += 1
+
+	def query(self, form, k=1):
+		"""Return [(neighbor, distance)] for the forms within edit distance 1..k of form.
+
+		Sorted by distance, then neighbor; form itself is not included.
+		"""
+		results = []
+		n = len(form)
+		outside = k + 1
+		first_row = list(range(n + 1))
+		stack = [(child, char, first_row, 1) for char, child in self.root.items() if char is not None]
+		while stack:
+			node, char, previous, depth = stack.pop()
+			# Only cells within k of the diagonal can hold distances <= k.
+			low, high = max(1, depth - k), min(n, depth + k)
+			row = [depth if depth <= k else outside] + [outside] * n
+			for i in range(low, high + 1):
+				row[i] = min(row[i-1] + 1, previous[i] + 1, previous[i-1] + (form[i-1] != char), outside)
+			if None in node and 0 < row[n] <= k:
+				results.append((node[None], row[n]))
+			if min(row[low-1:high+1]) <= k:
+				stack.extend((child, c, row, depth + 1) for c, child in node.items() if c is not None)
+		return sorted(results, key=lambda result: (result[1], result[0]))
+
+	def query_many(self, forms, k=1):
+		"""Query many forms; returns a dataframe of query, neighbor and distance rows."""
+		rows = [(form, neighbor, distance) for form in dict.fromkeys(forms)
+				for neighbor, distance in self.query(form, k=k)]
+		return pd.DataFrame(rows, columns=['query', 'neighbor', 'distance'])
+
+
 class Lexicon(object):
 	"""Class for representing lexicon as a graph structure."""
 
 	def __init__(self):
 		self.words = []
 		self.edges = []
+		self.neighbor_index = NeighborIndex()
+
+	def __contains__(self, word):
+		"""Is wordform (a string or Wordform) already in the lexicon?"""
+		return getattr(word, 'wordform', word) in self.neighbor_index.ids
+
+	def get_word(self, word):
+		"""Return the Wordform entry for wordform (a string or Wordform)."""
+		return self.words[self.neighbor_index.ids[getattr(word, 'wordform', word)]]
 
 	def add_word(self, word):
 		"""Add word to lexicon."""
-		if word in self.words:
-			target = self.words[self.words.index(word)]
+		if word in self:
+			target = self.get_word(word)
 			target.add_entry()
 		else:
 			self.get_neighbors(word)
 			self.words.append(word)
+			self.neighbor_index.add(word.wordform)
 
 
 	def get_neighbors(self, word):
 		"""Get neighbors of word."""
-		regex = re.compile(generate_mp_regex(word.wordform))
-		# matches = [w.wordform for w in self.words if w not in seen and regex.match(w)]
-		matches = [w for w in self.words if regex.match(w.wordform) and w.wordform != word.wordform]
+		matches = [self.words[i] for i in self.neighbor_index.query(word.wordform)]
 		for neighbor in matches:
 			new_edge = Edge(word, neighbor)
 			self.edges.append(new_edge)
@@ -103,6 +236,214 @@ class Lexicon(object):
 		return r
 
 
+class FenwickTree(object):
+	"""Binary indexed tree over non-negative integer keys, growing as larger keys arrive."""
+
+	def __init__(self, size=16):
+		self.tree = [0] * (size + 1)
+		self.total = 0
+
+	def add(self, key, delta):
+		"""Add delta to the count at key, in O(log n)."""
+		while key + 1 >= len(self.tree):
+			self.grow()
+		self.total += delta
+		i = key + 1
+		while i < len(self.tree):
+			self.tree[i] += delta
+			i += i & -i
+
+	def prefix_sum(self, key):
+		"""Sum of the counts at keys 0..key, in O(log n)."""
+		i = min(key + 1, len(self.tree) - 1)
+		result = 0
+		while i > 0:
+			result += self.tree[i]
+			i -= i & -i
+		return result
+
+	def grow(self):
+		"""Double the key range, rebuilding the tree from the point counts."""
+		size = len(self.tree) - 1
+		counts = [self.prefix_sum(i) - self.prefix_sum(i - 1) for i in range(size)]
+		self.tree = [0] * (2 * size + 1)
+		self.total = 0
+		for key, count in enumerate(counts):
+			if count:
+				self.add(key, count)
+
+
+class CompactWordform(object):
+	"""Read-only view of one node of a CompactLexicon, with the Wordform attributes."""
+
+	__slots__ = ('lexicon', 'id')
+
+	def __init__(self, lexicon, node_id):
+		self.lexicon = lexicon
+		self.id = node_id
+
+	@property
+	def wordform(self):
+		return self.lexicon.neighbor_index.forms[self.id]
+
+	@property
+	def surprisal(self):
+		return self.lexicon.surprisals[self.id]
+
+	@property
+	def num_sylls(self):
+		return self.lexicon.num_sylls[self.id]
+
+	@property
+	def num_phones(self):
+		return len(self.wordform)
+
+	@property
+	def homophones(self):
+		return self.lexicon.homophones[self.id]
+
+	@property
+	def neighbors(self):
+		return [CompactWordform(self.lexicon, i) for i in self.lexicon.neighbor_ids(self.id)]
+
+	def __repr__(self):
+		return self.wordform
+
+	def __eq__(self, target):
+		return self.wordform == target
+
+	def add_entry(self):
+		self.lexicon.add_entry(self.id)
+
+
+class CompactLexicon(object):
+	"""Array-backed alternative to Lexicon.
+
+	Nodes are integer ids (in insertion order) with their attributes in parallel arrays.
+	Minimal pairs are appended to an edge buffer and finalized into CSR adjacency
+	(indptr, indices) the next time neighbors are asked for, so no Edge objects or
+	per-word neighbor lists are kept. Neighborhood sizes are tracked as edges are added,
+	and a Fenwick tree over homophone counts answers homophone rank queries.
+	"""
+
+	def __init__(self):
+		self.neighbor_index = NeighborIndex()
+		self.surprisals = array('d')
+		self.num_sylls = array('l')
+		self.homophones = array('l')
+		self.degrees = array('l')
+		self.homophone_counts = FenwickTree()
+
+		# Edge buffer (w1 is the word added later, as in Lexicon.edges)
+		self.edge_sources = array('l')
+		self.edge_targets = array('l')
+
+		self.indptr = np.zeros(1, dtype=np.int64)
+		self.indices = np.zeros(0, dtype=np.int64)
+		self.finalized_edges = 0
+
+	def __len__(self):
+		return len(self.neighbor_index)
+
+	def __contains__(self, word):
+		"""Is wordform (a string or Wordform) already in the lexicon?"""
+		return getattr(word, 'wordform', word) in self.neighbor_index.ids
+
+	def get_word(self, word):
+		"""Return a view of the entry for wordform (a string or Wordform)."""
+		return CompactWordform(self, self.neighbor_index.ids[getattr(word, 'wordform', word)])
+
+	@property
+	def words(self):
+		return [CompactWordform(self, i) for i in range(len(self))]
+
+	@property
+	def edges(self):
+		return [Edge(CompactWordform(self, w1), CompactWordform(self, w2))
+				for w1, w2 in zip(self.edge_sources, self.edge_targets)]
+
+	def add_word(self, word):
+		"""Add word (a Wordform) to lexicon."""
+		if word in self:
+			self.add_entry(self.neighbor_index.ids[word.wordform])
+			return
+		neighbor_ids = self.neighbor_index.query(word.wordform)
+		node_id = self.neighbor_index.add(word.wordform)
+		self.surprisals.append(word.surprisal)
+		self.num_sylls.append(word.num_sylls)
+		self.homophones.append(word.homophones)
+		self.degrees.append(len(neighbor_ids))
+		self.homophone_counts.add(word.homophones, 1)
+		for neighbor_id in neighbor_ids:
+			self.edge_sources.append(node_id)
+			self.edge_targets.append(neighbor_id)
+			self.degrees[neighbor_id] += 1
+
+	def neighbor_count(self, word):
+		"""Number of neighbors wordform (a string or Wordform) has, or would have if added."""
+		form = getattr(word, 'wordform', word)
+		if form in self.neighbor_index.ids:
+			return self.degrees[self.neighbor_index.ids[form]]
+		return len(self.neighbor_index.query(form))
+
+	def add_entry(self, node_id):
+		"""Record another homophone of node_id."""
+		self.homophone_counts.add(self.homophones[node_id], -1)
+		self.homophones[node_id] += 1
+		self.homophone_counts.add(self.homophones[node_id], 1)
+
+	def homophone_rank(self, num_homophones):
+		"""Best rank (1 = most homophones) among words with num_homophones homophones.
+
+		Equal to the minimum of num_homophones.rank(ascending=False, method="first") over
+		those words, i.e. one more than the number of words with more homophones.
+		"""
+		return float(self.homophone_counts.total - self.homophone_counts.prefix_sum(num_homophones) + 1)
+
+	def finalize(self):
+		"""Build CSR adjacency from the edge buffer; neighbors of each node sorted by id."""
+		if self.finalized_edges == len(self.edge_sources) and len(self.indptr) == len(self) + 1:
+			return
+		sources = np.frombuffer(self.edge_sources, dtype='l')
+		targets = np.frombuffer(self.edge_targets, dtype='l')
+		rows = np.concatenate([sources, targets]).astype(np.int64)
+		cols = np.concatenate([targets, sources]).astype(np.int64)
+		order = np.lexsort((cols, rows))
+		self.indices = cols[order]
+		self.indptr = np.zeros(len(self) + 1, dtype=np.int64)
+		np.cumsum(np.bincount(rows, minlength=len(self)), out=self.indptr[1:])
+		self.finalized_edges = len(self.edge_sources)
+
+	def neighbor_ids(self, node_id):
+		"""Ids of the neighbors of node_id, in the order Lexicon lists them."""
+		self.finalize()
+		return self.indices[self.indptr[node_id]:self.indptr[node_id + 1]].tolist()
+
+	def adjacency(self):
+		"""Symmetric CSR adjacency matrix of the minimal-pair graph (see src.graph_analysis)."""
+		self.finalize()
+		return sp.csr_matrix((np.ones(len(self.indices), dtype=np.int64), self.indices, self.indptr),
+							 shape=(len(self), len(self)))
+
+	def create_dict(self, lex_num=1):
+		"""Turn CompactLexicon object into dictionary."""
+		return [{
+			'word': form,
+			'num_phones': len(form),
+			'prob': -surprisal,
+			'num_sylls_est': num_sylls,
+			'surprisal': surprisal,
+			'lexicon': lex_num,
+			'num_homophones': homophones,
+			'neighborhood_size': degree
+			} for form, surprisal, num_sylls, homophones, degree in zip(
+				self.neighbor_index.forms, self.surprisals, self.num_sylls, self.homophones, self.degrees)]
+
+	def __repr__(self):
+		"""Returns string representation of lexicon."""
+		return Lexicon.__repr__(self)
+
+
 ### TODO: Check that this approach returns the same # as the other minimal pair functions
 
 
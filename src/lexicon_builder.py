@@ -1,14 +1,16 @@
 """Class for building artificial lexica."""
 
-import random
 import re
 
 import numpy as np
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from tqdm import tqdm
 
 from src.utils import count_syllables, has_correct_tones, is_wellformed
-from src.lexicon import Wordform, Edge, Lexicon
+from src.lexicon import Wordform, Edge, Lexicon, CompactLexicon
+from src.generative_model import LengthConditionedSampler, PhonotacticAutomaton
 
 
 ## TODO: Wrap utilities into their own class
@@ -19,10 +21,47 @@ def re_split(delimiters, string, maxsplit=0):
     regexPattern = '|'.join(map(re.escape, delimiters))
     return re.split(regexPattern, string, maxsplit)
 
+
+# Per-process length-conditioned sampler for build_lexicon_parallel, set once by init_bin_worker.
+bin_worker = {}
+
+
+def init_bin_worker(sampler):
+    """Store the read-only sampler for this process."""
+    bin_worker['sampler'] = sampler
+
+
+def fill_bin(job):
+    """Draw count words of one length bin; returns (words, log10 probabilities)."""
+    length, count, seed = job
+    return bin_worker['sampler'].generate_batch(np.full(count, length), seed)
+
+
+def monotone_probability(num_neighbors, rate, base):
+    return 1 - (1 - base) * np.exp(-rate * num_neighbors)
+
+
+def inverse_u_probability(num_neighbors, peak, width, base):
+    return base + (1 - base) * np.exp(-0.5 * ((num_neighbors - peak) / width) ** 2)
+
+
+def monotone_acceptance(rate=0.5, base=0.1):
+    """p(add(word)) rising from base (no neighbors) towards 1 as #neighbors grows.
+
+    A partial over a module-level function, so it pickles into worker processes."""
+    return partial(monotone_probability, rate=rate, base=base)
+
+
+def inverse_u_acceptance(peak=2, width=2.0, base=0.1):
+    """p(add(word)) highest for words with ~peak neighbors, falling to base on either side.
+
+    A partial over a module-level function, so it pickles into worker processes."""
+    return partial(inverse_u_probability, peak=peak, width=width, base=base)
+
 class LexiconBuilder(object):
 
     def __init__(self, language, length_dist, lm, vowels, match_on, rank_distribution, 
-                 original_lexicon, surprisals, phonemes, mode='neutral'):
+                 original_lexicon, surprisals, phonemes, mode='neutral', seed=None, acceptance=None):
         """Initialize class.
 
         Parameters
@@ -45,10 +84,15 @@ class LexiconBuilder(object):
           allowable phonemes in language
         mode: str
           one of {'neutral', 'anti_homophones', 'pro_neighborhoods'}
-          currently unimplemented, but will operate in the following way:
+          operates in the following way:
             'neutral': p(add(word))=1 for all words satisfying #syllable requirements.
             'anti_homophones': p(add(word)) starts at/close to 1, decreases with #homophones.
-            'pro_neighborhoods': p(add(word)) starts close to 0, increases with #neighborhoods.
+            'pro_neighborhoods': p(add(word)) = acceptance(#neighbors word would have).
+        seed: int or np.random.Generator
+          seed for the batched candidate generator (None draws fresh entropy)
+        acceptance: function
+          maps the #neighbors a word would have to p(add(word)) in 'pro_neighborhoods' mode,
+          e.g. monotone_acceptance() (the default) or inverse_u_acceptance()
 
         """
         self.language = language
@@ -58,6 +102,10 @@ class LexiconBuilder(object):
         self.vowels = list(vowels)
         self.phonemes = phonemes
         self.mode = mode
+        self.rng = np.random.default_rng(seed)
+        self.batch_size = 1000
+        self.sampler = None
+        self.acceptance = acceptance if acceptance is not None else monotone_acceptance()
 
         self.set_parameters(mode=mode, rank_distribution=rank_distribution, surprisals=surprisals, original_lexicon=original_lexicon)
         self.setup()
@@ -68,7 +116,8 @@ class LexiconBuilder(object):
         self.artificial_lengths = self.length_dist.copy()
         self.new_lexicon = []
         self.new_words = []
-        self.lexicon = Lexicon()
+        self.candidates = []
+        self.lexicon = CompactLexicon()
 
         self.consonants = [i for i in self.phonemes if i not in self.vowels]
         print(self.consonants)
@@ -79,6 +128,7 @@ class LexiconBuilder(object):
         self.mode = mode
         self.rank_distribution = rank_distribution
         self.surprisals = surprisals
+        self.max_surprisal = max(surprisals)
         self.original_lexicon = original_lexicon
 
 
@@ -91,8 +141,8 @@ class LexiconBuilder(object):
     def build_lexicon(self, lex_num):
         """Build a lexicon according to the parameters."""
         with tqdm(total=sum(self.length_dist.values())) as progress_bar:
-            while True:
-                candidate = self.create_word()
+            while any(count > 0 for count in self.artificial_lengths.values()):
+                candidate, candidate_prob = self.create_word()
 
                 if self.satisfies_criteria(candidate):
 
@@ -103,42 +153,171 @@ class LexiconBuilder(object):
                         # Decrement required words of that length
                         self.artificial_lengths[word_length] -= 1
 
-                        # Get word probability
-                        prob = self.lm.evaluate(w)[2]
-
-                        # Add to bank of words
-                        self.new_lexicon.append(w)
-
-                        # Count #syllables
-                        num_sylls = count_syllables(w, language=self.language, vowels=self.vowels)
-
-                        # Add to lexicon: og style
-                        self.new_words.append({
-                            'word': w,
-                            'num_phones': len(w),
-                            'prob': prob,
-                            'num_sylls_est': num_sylls,
-                            'surprisal': -prob,
-                            'lexicon': lex_num,
-                            'mode': self.mode
-                            })
+                        # Get word probability (known from sampling, unless converted to a neighbor)
+                        prob = candidate_prob if w == candidate else self.lm.evaluate(w)[2]
 
-                        # Add word to lexicon graph: new style
-                        word = Wordform(wordform=w, surprisal=-prob, num_sylls=num_sylls)
-                        self.lexicon.add_word(word)
+                        self.record_word(w, prob, lex_num)
 
                         progress_bar.update(1)
 
                 # elif sum(self.artificial_lengths.values()) < 10:
                 #    raise Exception("Fix this!!!")
 
-                elif sum(self.artificial_lengths.values()) == 0:
-                    return pd.DataFrame(self.new_words)
+        return pd.DataFrame(self.new_words)
+
+    def build_lexicon_parallel(self, lex_num, max_workers=None, chunk_size=10000):
+        """Build a neutral lexicon with its length bins filled concurrently.
+
+        In neutral mode every candidate of a still-open length is accepted, so each bin's quota
+        can be drawn independently from the length-conditioned sampler (see draw_bins), and the
+        words are merged into the lexicon graph afterwards. Japanese has no length-conditioned
+        sampler and is built sequentially.
+        """
+        if self.mode != 'neutral':
+            raise ValueError("Only neutral lexica can be built bin by bin, not mode {x}.".format(x=self.mode))
+        if self.language == 'japanese':
+            return self.build_lexicon(lex_num)
+
+        for length, words, log_probs in self.draw_bins(self.artificial_lengths, max_workers, chunk_size):
+            for w, prob in zip(words, log_probs):
+                self.record_word(w, prob, lex_num)
+            self.artificial_lengths[length] -= len(words)
+
+        return pd.DataFrame(self.new_words)
 
+    def draw_bins(self, quotas, max_workers=None, chunk_size=10000):
+        """Draw quotas[length] words of each length from the length-conditioned sampler.
+
+        Quotas are split into chunks of at most chunk_size words, each seeded from self.rng (so
+        the draws do not depend on max_workers) and drawn in a process pool. Yields
+        (length, words, log10 probabilities) per chunk, in order of length.
+        """
+        sampler = self.length_sampler()
+        jobs = [(length, min(chunk_size, count - start))
+                for length, count in sorted(quotas.items())
+                for start in range(0, count, chunk_size)]
+        impossible = [length for length, _ in jobs if sampler.length_probabilities()[length] == 0]
+        if impossible:
+            raise ValueError("The model cannot generate words of lengths {x}.".format(x=sorted(set(impossible))))
+        seeds = np.random.SeedSequence(self.rng.integers(2**63)).spawn(len(jobs))
+        jobs = [(length, count, seed) for (length, count), seed in zip(jobs, seeds)]
+
+        if max_workers == 1:
+            init_bin_worker(sampler)
+            for job in tqdm(jobs):
+                yield (job[0],) + fill_bin(job)
+        else:
+            with ProcessPoolExecutor(max_workers=max_workers, initializer=init_bin_worker,
+                                     initargs=(sampler,)) as executor:
+                for job, (words, log_probs) in tqdm(zip(jobs, executor.map(fill_bin, jobs)), total=len(jobs)):
+                    yield job[0], words, log_probs
+
+    def generate_pool(self, num_lexica, max_workers=None):
+        """Generate and score a pool of candidates for num_lexica neutral lexica at once.
+
+        Draws num_lexica times each length quota in one pass and gives every entry of a bin
+        a slot from a permutation seeded by self.rng. Returns a dataframe of word, length_bin,
+        slot, prob (log10) and surprisal, for build_lexicon_from_pool.
+        """
+        if self.language == 'japanese':
+            raise ValueError("Japanese has no length-conditioned sampler to draw a pool from.")
+        quotas = {length: count * num_lexica for length, count in self.length_dist.items()}
+        pool = [pd.DataFrame({'word': words, 'length_bin': length, 'prob': log_probs})
+                for length, words, log_probs in self.draw_bins(quotas, max_workers)]
+        pool = pd.concat(pool, ignore_index=True)
+        pool['slot'] = 0
+        for length, rows in pool.groupby('length_bin').indices.items():
+            pool.loc[rows, 'slot'] = self.rng.permutation(len(rows))
+        pool['surprisal'] = -pool['prob']
+        return pool[['word', 'length_bin', 'slot', 'prob', 'surprisal']]
+
+    def build_lexicon_from_pool(self, pool, lex_num, slice_index=None):
+        """Assemble a neutral lexicon from a candidate pool (see generate_pool).
+
+        Lexicon slice_index (lex_num by default) takes slots [i*quota, (i+1)*quota) of each
+        bin. Pool entries are independent draws from the length-conditioned sampler and the
+        slices of different lexica are disjoint, so the lexica are independent, each distributed
+        as if generated separately.
+        """
+        if self.mode != 'neutral':
+            raise ValueError("Only neutral lexica can be assembled from a pool, not mode {x}.".format(x=self.mode))
+        i = lex_num if slice_index is None else slice_index
+
+        bins = dict(list(pool.groupby('length_bin')))
+        for length, count in sorted(self.artificial_lengths.items()):
+            if count == 0:
+                continue
+            rows = bins.get(length)
+            if rows is None or len(rows) < (i + 1) * count:
+                raise ValueError("The pool has fewer than {c} words of length {l}.".format(c=(i + 1) * count, l=length))
+            chosen = rows[(rows['slot'] >= i * count) & (rows['slot'] < (i + 1) * count)].sort_values('slot')
+            for w, prob in zip(chosen['word'].values, chosen['prob'].values):
+                self.record_word(w, prob, lex_num)
+            self.artificial_lengths[length] -= count
+
+        return pd.DataFrame(self.new_words)
+
+    def record_word(self, w, prob, lex_num):
+        """Add accepted word w (with log probability prob) to the new lexicon."""
+        # Add to bank of words
+        self.new_lexicon.append(w)
+
+        # Count #syllables
+        num_sylls = count_syllables(w, language=self.language, vowels=self.vowels)
+
+        # Add to lexicon: og style
+        self.new_words.append({
+            'word': w,
+            'num_phones': len(w),
+            'prob': prob,
+            'num_sylls_est': num_sylls,
+            'surprisal': -prob,
+            'lexicon': lex_num,
+            'mode': self.mode
+            })
+
+        # Add word to lexicon graph: new style
+        word = Wordform(wordform=w, surprisal=-prob, num_sylls=num_sylls)
+        self.lexicon.add_word(word)
 
     def create_word(self):
-        """Generate a word."""
-        return self.lm.generate()[0]
+        """Generate a word, returning it with its log probability.
+
+        Candidates are drawn from the model in batches and handed out one at a time."""
+        if not self.candidates:
+            words, log_probs = self.generate_candidates()
+            self.candidates = list(zip(words, log_probs))[::-1]
+        return self.candidates.pop()
+
+    def generate_candidates(self):
+        """Draw a batch of candidates whose lengths fall in bins that still need words.
+
+        Each candidate's bin is drawn in proportion to the model's probability of producing
+        a word of that length, and the word is then sampled conditioned on that length. This
+        is the distribution of the words the old generate-and-reject loop accepted, without
+        generating the rejected ones. (Japanese syllable counts also depend on geminates, so
+        Japanese keeps generating unconstrained words.)
+        """
+        if self.language == 'japanese':
+            return self.lm.generate_batch(self.batch_size, self.rng)
+
+        sampler = self.length_sampler()
+        open_bins = np.array([l for l, count in self.artificial_lengths.items() if count > 0])
+        weights = sampler.length_probabilities()[open_bins]
+        if weights.sum() == 0:
+            raise ValueError("The model cannot generate words of lengths {x}.".format(x=list(open_bins)))
+
+        num_candidates = min(self.batch_size, sum(self.artificial_lengths[l] for l in open_bins))
+        lengths = self.rng.choice(open_bins, size=num_candidates, p=weights / weights.sum())
+        return sampler.generate_batch(lengths, self.rng)
+
+    def length_sampler(self):
+        """The (lazily built) sampler of well-formed words conditioned on their length bin."""
+        if self.sampler is None:
+            self.sampler = LengthConditionedSampler(self.lm, self.vowels, match_on=self.match_on,
+                                                    max_length=max(self.length_dist),
+                                                    automaton=self.wellformedness_automaton())
+        return self.sampler
 
     def is_wellformed(self, w):
         """Is word well-formed?
@@ -176,6 +355,33 @@ class LexiconBuilder(object):
 
         return True
 
+    def wellformedness_automaton(self):
+        """Return the word-shape checks of satisfies_criteria as a PhonotacticAutomaton.
+
+        Every word needs a vowel; Mandarin words also need every tone-delimited syllable to
+        pass is_wellformed. The automaton tracks the current syllable with each phone
+        replaced by a representative of its role in that check, so it has few states.
+        """
+        automaton = PhonotacticAutomaton.vowel_required(self.vowels)
+        if self.language != 'mandarin':
+            return automaton
+
+        tones = ['0', '1', '2', '3', '4']
+
+        def representative(unit):
+            if unit in self.vowels:
+                return self.vowels[0]
+            return unit if unit in 'Gnŋɹ ' else '.'
+
+        def step(syllable, unit):
+            if unit in tones:
+                return '' if self.is_wellformed(syllable + unit) else None
+            # A syllable has at most four phones, so longer ones are all equally ill-formed.
+            syllable += representative(unit)
+            return syllable if len(syllable) <= 4 else '.....'
+
+        return automaton & PhonotacticAutomaton('', step, lambda syllable: True)
+
     def has_correct_tones(self, w):
         """Checks whether word in Mandarin has correct tones and placement of tones."""
         raise Exception
@@ -186,6 +392,10 @@ class LexiconBuilder(object):
 
         word_length = self.get_word_length(w)
 
+        # Words from the length-conditioned sampler already satisfy wellformedness_automaton().
+        if self.sampler is not None:
+            return self.artificial_lengths[word_length] > 0
+
         if self.language == 'mandarin':
             if not self.is_wellformed(w): # or not has_correct_tones(w):
                 return False
@@ -203,18 +413,14 @@ class LexiconBuilder(object):
         elif self.mode == 'anti_homophones':
             ## New method: use rank distribution
 
-            if w not in self.lexicon.words:
+            if w not in self.lexicon:
                 return w
 
-            entry = self.lexicon.words[self.lexicon.words.index(w)]
+            entry = self.lexicon.get_word(w)
             num_homophones = entry.homophones
 
-            # Generate a lexicon from current set of words.
-            current_lexicon = pd.DataFrame(self.lexicon.create_dict())
-            current_lexicon['rank_num_homophones'] = current_lexicon['num_homophones'].rank(ascending=False, method="first")
-
             ## Get rank of highest-ranked word with same # homophones
-            max_rank = current_lexicon[current_lexicon['num_homophones']==num_homophones]['rank_num_homophones'].min()
+            max_rank = self.lexicon.homophone_rank(num_homophones)
 
             # If word already has >=1 entry, yet is ranked *lower* than the number of words
             # in the original lexicon, don't add it
@@ -233,24 +439,20 @@ class LexiconBuilder(object):
         elif self.mode == 'anti_homophones_plus':
             ## New method: use rank distribution
 
-            if w not in self.lexicon.words:
+            if w not in self.lexicon:
                 return w
 
-            entry = self.lexicon.words[self.lexicon.words.index(w)]
+            entry = self.lexicon.get_word(w)
             num_homophones = entry.homophones
 
-            # Generate a lexicon from current set of words.
-            current_lexicon = pd.DataFrame(self.lexicon.create_dict())
-            current_lexicon['rank_num_homophones'] = current_lexicon['num_homophones'].rank(ascending=False, method="first")
-
             ## Get rank of highest-ranked word with same # homophones
-            max_rank = current_lexicon[current_lexicon['num_homophones']==num_homophones]['rank_num_homophones'].min()
+            max_rank = self.lexicon.homophone_rank(num_homophones)
 
             # If word already has >=1 entry, yet is ranked *lower* than the number of words
             # in the original lexicon, don't add it
             if max_rank not in self.rank_distribution:
                 w2 = self.convert_to_neighbor(w)
-                return self.add_word(w2)
+                return self.add_word(w2) if w2 is not None else None
 
             # How many homophones does the N-th ranked word have in real lexicon?
             allowable_homophones = self.rank_distribution[max_rank]
@@ -263,15 +465,18 @@ class LexiconBuilder(object):
                 if self.language == "japanese" and len(w) == 1:
                     return None
                 w2 = self.convert_to_neighbor(w)
-                return self.add_word(w2)
+                return self.add_word(w2) if w2 is not None else None
 
         elif self.mode == 'pro_neighborhoods':
 
-            raise NotImplementedError("Neighborhood selection process not yet implemented.")
-            ## TODO: Count number of neighbors of candidate word. 
-            ## If word already exists in lexicon, this is easy.
-            ## Otherwise, count how many neighbors word would have. And increase p(add(word)) at some rate relative to that.
-            #### Unless we think it's non-monotonic or even inverse-U? I.e., some neighbors are good, up to a point?
+            ## Count number of neighbors the word has (or would have), without adding it.
+            num_neighbors = self.lexicon.neighbor_count(w)
+
+            ## Add with probability given by the acceptance function (monotone, inverse-U, ...)
+            if self.rng.random() < self.acceptance(num_neighbors):
+                return w
+            else:
+                return None
 
         elif self.mode == "real_only":
 
@@ -283,32 +488,27 @@ class LexiconBuilder(object):
 
 
 
-    def convert_to_neighbor(self, w):
-        """Converts word to a near neighbor using a random edit."""
-
-        while True:
-            ## First select random index of word
-            index = random.randrange(0, len(w))
-
-            ## determine whether to replace with either vowel or consonant
-            replacement_vector = self.vowels if w[index] in self.vowels else self.consonants
-
-            ## Then sample random replacement
-            replacement_token = random.choice([k for k in replacement_vector if k != w[index]])
-
-            ## now replace
-            w_list = list(w)
-            w_list[index] = replacement_token
-            new_word = ''.join(w_list)
+    def neighbor_candidates(self, w):
+        """All words one same-class substitution (vowel for vowel, consonant for consonant) away from w."""
+        candidates = []
+        for index, phoneme in enumerate(w):
+            replacement_vector = self.vowels if phoneme in self.vowels else self.consonants
+            candidates.extend(w[:index] + k + w[index+1:] for k in replacement_vector if k != phoneme)
+        return candidates
 
-            print(new_word)
-
-            ## check for satisfaction of surprisal
-            surprisal = -self.lm.evaluate(new_word)[2]
-            if surprisal < max(self.surprisals):
-                ## if surprisal is low enough, add to dictionary
-                break
-            else:
-                print("Surprisal too high!!!")
-        return new_word
+    def convert_to_neighbor(self, w):
+        """Converts word to a near neighbor using a random edit.
+
+        Scores every same-class substitution of w in one batch and samples uniformly among
+        those no more surprising than the most surprising real word. Returns None if there are none."""
+        candidates = self.neighbor_candidates(w)
+        if not candidates:
+            return None
+
+        ## check for satisfaction of surprisal
+        surprisals = -self.lm.evaluate_many(candidates)[2]
+        allowed = np.flatnonzero(surprisals < self.max_surprisal)
+        if len(allowed) == 0:
+            return None
+        return candidates[allowed[self.rng.integers(len(allowed))]]
 
@@ -2,19 +2,19 @@
 
 import os
 import os.path as op
+import numpy as np
 import pandas as pd 
 import itertools
-import math
 
 import editdistance as ed
 
-from collections import defaultdict
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
 
 import src.config as config
 import src.utils as utils
 
-import re
 
 
 def generate_mp_regex(wordform):
@@ -38,25 +38,129 @@ def generate_mp_regex(wordform):
     return regex
 
 def find_minimal_pairs_lazy(wordforms):
-    word_to_size = defaultdict(int)
-    # unique_combos = math.factorial(len(wordforms)) / (math.factorial(2) * (math.factorial(len(wordforms)-2)))
-    seen = set()
-    for w1 in tqdm(wordforms):
-        seen.add(w1)
-        regex = re.compile(generate_mp_regex(w1))
-        matches = [w for w in wordforms if w not in seen and regex.match(w)]
-        for w2 in matches:
-            word_to_size[w1] += 1
-            word_to_size[w2] += 1
+    """For each word, find number of minimal pairs (see find_minimal_pairs)."""
+    word_to_size, _ = find_minimal_pairs(wordforms)
     return word_to_size
 
 
-def find_minimal_pairs(wordforms, counts):
-    """For each word, find number of minimal pairs."""
+def substitution_counts(job):
+    """Neighbor counts among forms of one length (a (L, L) bucket job).
+
+    Two forms of the same length are neighbors iff they share a wildcard key (a position and the
+    form without that position); they then share exactly one, so summing group sizes over keys
+    counts each pair once. Returns (sizes, weighted) aligned with forms.
+    """
+    forms, weights = job
+    num_forms = len(forms)
+    key_ids = np.array([i for i, w in enumerate(forms) for _ in range(len(w))], dtype=np.int64)
+    keys = pd.Series(["{i}|{rest}".format(i=index, rest=w[:index] + w[index+1:])
+                      for w in forms for index in range(len(w))])
+    groups = keys.groupby(keys.values)
+    sizes = np.bincount(key_ids, weights=groups.transform('size').values - 1,
+                        minlength=num_forms).astype(np.int64)
+    weighted = None
+    if weights is not None:
+        group_weights = pd.Series(weights[key_ids]).groupby(keys.values).transform('sum').values
+        weighted = np.bincount(key_ids, weights=group_weights - weights[key_ids], minlength=num_forms)
+    return sizes, weighted
+
+
+def indel_counts(job):
+    """Neighbor counts between forms of lengths L and L+1 (a (L, L+1) bucket job).
+
+    A short form is a neighbor of a long one iff it is one of the long form's (distinct)
+    deletion variants. Returns (short sizes, short weighted, long sizes, long weighted).
+    """
+    short_forms, short_weights, long_forms, long_weights = job
+    ids = pd.Series(np.arange(len(short_forms)), index=short_forms)
+    pairs = pd.DataFrame([(i, w[:index] + w[index+1:]) for i, w in enumerate(long_forms) for index in range(len(w))],
+                         columns=['long', 'variant']).drop_duplicates()
+    pairs['short'] = pairs['variant'].map(ids)
+    pairs = pairs.dropna(subset=['short'])
+    longer, shorter = pairs['long'].values.astype(np.int64), pairs['short'].values.astype(np.int64)
+    short_sizes = np.bincount(shorter, minlength=len(short_forms))
+    long_sizes = np.bincount(longer, minlength=len(long_forms))
+    if short_weights is None:
+        return short_sizes, None, long_sizes, None
+    short_weighted = np.bincount(shorter, weights=long_weights[longer], minlength=len(short_forms))
+    long_weighted = np.bincount(longer, weights=short_weights[shorter], minlength=len(long_forms))
+    return short_sizes, short_weighted, long_sizes, long_weighted
+
+
+def neighbor_counts(forms, weights=None, max_workers=1):
+    """Count the neighbors (wordforms at edit distance 1) of each of a list of unique forms.
+
+    Edit distance 1 only links forms whose lengths differ by at most one, so forms are bucketed
+    by length and each (L, L) and (L, L+1) bucket pair is a separate job, O(N*L) in total.
+    With max_workers other than 1, jobs run in a process pool, largest estimated cost first.
+
+    Returns two arrays aligned with forms: the number of neighbors, and the summed weights of
+    the neighbors (if weights is given, else None).
+    """
+    num_forms = len(forms)
+    sizes = np.zeros(num_forms, dtype=np.int64)
+    weighted = np.zeros(num_forms) if weights is not None else None
+
+    lengths = np.fromiter(map(len, forms), dtype=np.int64, count=num_forms)
+    buckets = {length: np.flatnonzero(lengths == length) for length in np.unique(lengths)}
+    bucket_forms = {length: [forms[i] for i in ids] for length, ids in buckets.items()}
+    bucket_weights = {length: weights[ids] if weights is not None else None for length, ids in buckets.items()}
+
+    # (cost estimate, function, job, lengths whose counts the result holds)
+    jobs = [(len(ids) * length, substitution_counts, (bucket_forms[length], bucket_weights[length]), (length,))
+            for length, ids in buckets.items()]
+    jobs += [(len(buckets[length + 1]) * (length + 1) + len(ids), indel_counts,
+              (bucket_forms[length], bucket_weights[length], bucket_forms[length + 1], bucket_weights[length + 1]),
+              (length, length + 1))
+             for length, ids in buckets.items() if length + 1 in buckets]
+    jobs.sort(key=lambda job: -job[0])
+
+    if max_workers == 1:
+        results = (func(job) for _, func, job, _ in jobs)
+    else:
+        executor = ProcessPoolExecutor(max_workers=max_workers)
+        results = [executor.submit(func, job) for _, func, job, _ in jobs]
+        results = (future.result() for future in results)
+
+    try:
+        for (_, _, _, job_lengths), result in zip(jobs, results):
+            for length, (job_sizes, job_weighted) in zip(job_lengths, zip(result[::2], result[1::2])):
+                sizes[buckets[length]] += job_sizes
+                if weights is not None:
+                    weighted[buckets[length]] += job_weighted
+    finally:
+        if max_workers != 1:
+            executor.shutdown()
+
+    return sizes, weighted
+
+
+def find_minimal_pairs(wordforms, counts=None, max_workers=1):
+    """For each word, find number of minimal pairs.
+
+    Returns dictionaries mapping each (unique) word to its number of minimal pairs and, if
+    counts (#homophones per wordform) is given, to the number counting each neighbor's
+    homophones too. Same counts as find_minimal_pairs_brute_force, in O(N*L) instead of O(N^2);
+    max_workers other than 1 spreads the length buckets over a process pool.
+    """
+    forms = list(dict.fromkeys(wordforms))
+    weights = None
+    if counts is not None:
+        weights = pd.Series(counts).reindex(forms).fillna(0).values.astype(float) + 1
+    sizes, weighted = neighbor_counts(forms, weights, max_workers=max_workers)
+
+    word_to_size = defaultdict(int, zip(forms, sizes.tolist()))
+    word_to_size_with_homophones = defaultdict(int)
+    if weighted is not None:
+        word_to_size_with_homophones.update(zip(forms, np.round(weighted).astype(np.int64).tolist()))
+    return word_to_size, word_to_size_with_homophones
+
+
+def find_minimal_pairs_brute_force(wordforms, counts):
+    """For each word, find number of minimal pairs by comparing every pair of wordforms."""
     word_to_size = defaultdict(int)
     word_to_size_with_homophones = defaultdict(int)
-    unique_combos = math.factorial(len(wordforms)) / (math.factorial(2) * (math.factorial(len(wordforms)-2)))
-    seen = []
+    unique_combos = len(wordforms) * (len(wordforms) - 1) // 2
     with tqdm(total=unique_combos) as progress_bar:
         for w1, w2 in itertools.combinations(wordforms, 2):
             # "Minimal pair" is defined here as wordforms 1 distance away. .
@@ -70,7 +174,97 @@ def find_minimal_pairs(wordforms, counts):
     return word_to_size, word_to_size_with_homophones
 
 
-def mps_for_lexicon(df_lex, phon_column="PhonDISC", unique=True):
+def deletion_variants(form, k):
+    """Map each variant of form with up to k phones deleted to the fewest deletions giving it."""
+    variants = {form: 0}
+    frontier = {form}
+    for deletions in range(1, k + 1):
+        frontier = {w[:index] + w[index+1:] for w in frontier for index in range(len(w))}
+        for variant in frontier:
+            variants.setdefault(variant, deletions)
+    return variants
+
+
+def candidate_pairs(forms, k):
+    """Pairs (a, b), a < b, of form ids sharing a variant with up to k deletions (symmetric delete).
+
+    Every pair at edit distance <= k shares such a variant, so this is a superset of them.
+    """
+    table = pd.DataFrame([(variant, i) for i, w in enumerate(forms) for variant in deletion_variants(w, k)],
+                         columns=['variant', 'id'])
+    pairs = table.merge(table, on='variant')
+    pairs = pairs[pairs['id_x'] < pairs['id_y']]
+    return pairs[['id_x', 'id_y']].drop_duplicates().values.astype(np.int64)
+
+
+def first_difference(w1, w2):
+    """First position at which w1 and w2 differ (the shorter length if one is a prefix)."""
+    for index, (x, y) in enumerate(zip(w1, w2)):
+        if x != y:
+            return index
+    return min(len(w1), len(w2))
+
+
+def edit_neighborhoods(wordforms, k=2, positions=False):
+    """Count neighbors at each edit distance up to k for each unique wordform, in one pass.
+
+    Candidate pairs come from shared deletion variants and are verified with editdistance.
+    Returns a dataframe with one row per word and columns:
+      neighborhood_size_d{d}: neighbors at distance exactly d, for d = 1..k
+      neighborhood_size_le{k}: neighbors at distance <= k
+      substitution_neighbors / insertion_neighbors / deletion_neighbors: distance-1 neighbors
+        of the same length / one phone longer / one phone shorter
+    and, if positions, substitutions_at_{i} / insertions_at_{i} / deletions_at_{i}: the same
+    counts by the position of the edit in the word (insertions by the gap they fill).
+    """
+    forms = list(dict.fromkeys(wordforms))
+    num_forms = len(forms)
+    lengths = np.fromiter(map(len, forms), dtype=np.int64, count=num_forms)
+
+    pairs = candidate_pairs(forms, k)
+    a, b = pairs[:, 0], pairs[:, 1]
+    distances = np.fromiter((ed.eval(forms[x], forms[y]) for x, y in pairs), dtype=np.int64, count=len(pairs))
+
+    df_neighborhoods = pd.DataFrame({'word': forms})
+    for d in range(1, k + 1):
+        at_d = distances == d
+        df_neighborhoods['neighborhood_size_d{d}'.format(d=d)] = (np.bincount(a[at_d], minlength=num_forms) +
+                                                                  np.bincount(b[at_d], minlength=num_forms))
+    df_neighborhoods['neighborhood_size_le{k}'.format(k=k)] = df_neighborhoods[
+        ['neighborhood_size_d{d}'.format(d=d) for d in range(1, k + 1)]].sum(axis=1)
+
+    # Distance-1 breakdown; orient indel pairs as (shorter, longer).
+    at_1 = distances == 1
+    a1, b1 = a[at_1], b[at_1]
+    swap = lengths[a1] > lengths[b1]
+    short, long = np.where(swap, b1, a1), np.where(swap, a1, b1)
+    same = lengths[short] == lengths[long]
+    df_neighborhoods['substitution_neighbors'] = (np.bincount(short[same], minlength=num_forms) +
+                                                  np.bincount(long[same], minlength=num_forms))
+    df_neighborhoods['insertion_neighbors'] = np.bincount(short[~same], minlength=num_forms)
+    df_neighborhoods['deletion_neighbors'] = np.bincount(long[~same], minlength=num_forms)
+
+    if positions:
+        where = np.fromiter((first_difference(forms[x], forms[y]) for x, y in zip(short, long)),
+                            dtype=np.int64, count=len(short))
+        for i in range(lengths.max() + 1 if num_forms else 0):
+            at_i = where == i
+            df_neighborhoods['substitutions_at_{i}'.format(i=i)] = (
+                np.bincount(short[same & at_i], minlength=num_forms) + np.bincount(long[same & at_i], minlength=num_forms))
+            df_neighborhoods['insertions_at_{i}'.format(i=i)] = np.bincount(short[~same & at_i], minlength=num_forms)
+            df_neighborhoods['deletions_at_{i}'.format(i=i)] = np.bincount(long[~same & at_i], minlength=num_forms)
+
+    return df_neighborhoods
+
+
+def neighborhoods_for_lexicon(df_lex, phon_column="PhonDISC", k=2, positions=False):
+    """Get edit-distance neighborhoods (see edit_neighborhoods) for each word, put into lexicon."""
+    df_lex = df_lex.dropna(subset=[phon_column])
+    df_neighborhoods = edit_neighborhoods(df_lex[phon_column].values, k=k, positions=positions)
+    return df_lex.merge(df_neighborhoods.rename(columns={'word': phon_column}), on=phon_column, how='left')
+
+
+def mps_for_lexicon(df_lex, phon_column="PhonDISC", unique=True, max_workers=1):
     """Get minimal pairs for each word, put into lexicon."""
     df_lex = df_lex.dropna(subset=[phon_column])
 
@@ -86,23 +280,90 @@ def mps_for_lexicon(df_lex, phon_column="PhonDISC", unique=True):
     print("#words: {l}".format(l=num_wordforms))
 
     # Get num of minimal pairs
-    neighborhood_size, neighborhood_size_with_homophones = find_minimal_pairs(wordforms, counts=homophone_counts)
+    neighborhood_size, neighborhood_size_with_homophones = find_minimal_pairs(wordforms, counts=homophone_counts,
+                                                                               max_workers=max_workers)
     df_lex['neighborhood_size'] = df_lex[phon_column].apply(lambda x: neighborhood_size[x])
     df_lex['neighborhood_size_with_homophones'] = df_lex[phon_column].apply(lambda x: neighborhood_size_with_homophones[x])
     return df_lex
 
 
 
-def mps_for_artificials(df_arts, N):
-    """For each artificial lexicon, get minimal pairs for each word."""
-    artificials = []
-    for lex in range(N):
-        df_lex = df_arts[df_arts['lexicon']==lex]
-        df_lex = mps_for_lexicon(df_lex, phon_column='word')
-        artificials.append(df_lex)
-    df_all_arts = pd.concat(artificials)
-    
-    return df_all_arts
+def mps_for_artificial(job):
+    """Get minimal pairs for one artificial lexicon, given as (lex, df_lex)."""
+    lex, df_lex = job
+    return mps_for_lexicon(df_lex, phon_column='word')
+
+
+def ordered_map(func, jobs, max_workers=1):
+    """Map func over jobs in a process pool, yielding results in order.
+
+    At most about max_workers jobs are submitted ahead of the result being consumed, so only
+    a few jobs' inputs and outputs are held at once. max_workers=1 runs in this process.
+    """
+    if max_workers == 1:
+        for job in jobs:
+            yield func(job)
+        return
+    window = max_workers if max_workers is not None else os.cpu_count()
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+        for job in jobs:
+            pending.append(executor.submit(func, job))
+            if len(pending) > window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def read_lexica(path, chunksize=100000):
+    """Yield (lex, df_lex) for each artificial lexicon in a combined CSV, reading it in chunks.
+
+    Combined files are written lexicon by lexicon, so each lexicon's rows are contiguous and
+    only one lexicon (plus one chunk) is held at a time.
+    """
+    done = set()
+    current_lex, current = None, []
+    for chunk in pd.read_csv(path, chunksize=chunksize):
+        for lex, df_lex in chunk.groupby('lexicon', sort=False):
+            if current and lex != current_lex:
+                yield current_lex, pd.concat(current)
+                done.add(current_lex)
+                current = []
+            if lex in done:
+                raise ValueError("Rows of lexicon {x} are not contiguous in {path}.".format(x=lex, path=path))
+            current_lex = lex
+            current.append(df_lex)
+    if current:
+        yield current_lex, pd.concat(current)
+
+
+def read_lexicon_files(paths):
+    """Yield (lex, df_lex) for per-lexicon files (e.g. those written by src.generate_lexica), one at a time."""
+    for path in paths:
+        df_lex = pd.read_csv(path)
+        yield df_lex['lexicon'].values[0], df_lex
+
+
+def mps_for_artificials(df_arts, N, out_path=None, max_workers=1):
+    """For each artificial lexicon, get minimal pairs for each word.
+
+    df_arts is a dataframe of all lexica, or an iterable of (lex, df_lex) pairs such as
+    read_lexica or read_lexicon_files, which is consumed lazily. The lexica are processed
+    concurrently (max_workers, see ordered_map). Without out_path, returns all lexica
+    concatenated. With out_path, each lexicon is appended to that CSV as soon as it (and the
+    ones before it) are done, in lexicon order; with a lazy input only a few lexica are in
+    memory at once. Returns out_path.
+    """
+    lexica = df_arts.groupby('lexicon') if isinstance(df_arts, pd.DataFrame) else df_arts
+    jobs = ((lex, df_lex) for lex, df_lex in lexica if lex in range(N))
+    results = ordered_map(mps_for_artificial, jobs, max_workers=max_workers)
+
+    if out_path is None:
+        return pd.concat(list(results))
+
+    for index, df_lex in enumerate(results):
+        df_lex.to_csv(out_path, mode='w' if index == 0 else 'a', header=index == 0)
+    return out_path
 
 
 def main(language, N, matched, mp_dir, phon_column="PhonDISC", 
@@ -118,7 +379,6 @@ def main(language, N, matched, mp_dir, phon_column="PhonDISC",
 
     # Load lexicons
     df_real = pd.read_csv(op.join(dir_path, "{lan}_all_reals_{n}phone.csv".format(lan=language, n=nphones)))
-    df_artificials = pd.read_csv(artificial_path)
 
     # Get minimal pairs for real lexicon
     print("Getting minimal pairs for real lexicon...")
@@ -127,8 +387,8 @@ def main(language, N, matched, mp_dir, phon_column="PhonDISC",
 
     # Get minimal pairs for artificials
     print("Getting minimal pairs for artificial lexicons...")
-    df_arts_mps = mps_for_artificials(df_artificials, N=N)
-    df_arts_mps.to_csv("{dir}/{f}".format(dir=mp_dir, f=art_string.replace("sylls", "sylls_mps")))
+    mps_for_artificials(read_lexica(artificial_path), N=N, max_workers=None,
+                        out_path="{dir}/{f}".format(dir=mp_dir, f=art_string.replace("sylls", "sylls_mps")))
 
 
 
@@ -4,6 +4,7 @@ import numpy as np
 import pandas as pd
 
 from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 from sklearn.model_selection import LeaveOneOut, train_test_split, KFold
 from tqdm import tqdm
 
@@ -32,6 +33,65 @@ def get_config_dict(config, language):
             'smoothing': config.MODEL_INFO['smoothing']}
 
 
+### Held-out (cross-validated) surprisal
+def count_fold(job):
+    """Count n-grams for one fold's wordforms."""
+    wordforms, n = job
+    return NgramCounts.from_wordforms(wordforms, n)
+
+
+def score_fold(job):
+    """Compile one fold's model from its training counts and score its held-out words."""
+    language, fold, table, train_counts, test, smoothing = job
+    lm = table.compile(train_counts, smoothing)
+    log_probs = lm.evaluate_many(test)[2]
+    return pd.DataFrame({'language': language,
+                         'fold': fold,
+                         'word': test,
+                         'heldout_surprisal': -log_probs,
+                         'heldout_log_prob': log_probs})
+
+
+def calculate_heldout_surprisal_parallel(lexica, n=5, smoothing=.01, num_folds=10, max_workers=None):
+    """Calculate held-out surprisal for one or more lexica, spreading (language, fold) jobs over processes.
+
+    lexica maps each language to its wordforms. Every fold is counted once; each fold's model is
+    compiled from the language's total counts minus that fold's counts, which is the same model
+    as retraining on the remaining folds. Workers receive only their fold's wordforms or training
+    counts. Results come back in (language, fold, word) order whatever the number of workers;
+    max_workers=1 runs everything in this process.
+    """
+    tests = {}
+    for language, wordforms in lexica.items():
+        wordforms = np.array(wordforms)
+        tests[language] = [wordforms[test_indices] for train_indices, test_indices in KFold(n_splits=num_folds).split(wordforms)]
+    keys = [(language, fold) for language in tests for fold in range(num_folds)]
+
+    executor = ProcessPoolExecutor(max_workers=max_workers) if max_workers != 1 else None
+    mapper = executor.map if executor else map
+    try:
+        fold_counts = dict(zip(keys, mapper(count_fold, [(tests[language][fold], n) for language, fold in keys])))
+
+        jobs = []
+        for language in tests:
+            # The full lexicon's counts are the sum of its folds.
+            full_counts = NgramCounts(n)
+            for fold in range(num_folds):
+                full_counts.update(fold_counts[(language, fold)])
+            table = NgramTable(full_counts)
+            full_vector = table.entry_counts(full_counts)
+            for fold in range(num_folds):
+                train_counts = full_vector - table.entry_counts(fold_counts.pop((language, fold)))
+                jobs.append((language, fold, table, train_counts, tests[language][fold], smoothing))
+
+        held_out_data = list(tqdm(mapper(score_fold, jobs), total=len(jobs)))
+    finally:
+        if executor:
+            executor.shutdown()
+
+    return pd.concat(held_out_data, ignore_index=True)
+
+
 ### Class for preprocessing raw data files
 class Preprocessor(object):
 
@@ -186,34 +246,14 @@ class Preprocessor(object):
         self.df_processed.to_csv("data/processed/{lang1}/reals/{lang2}_with_mps_{n}phone.csv".format(lang1=self.language, lang2=self.language, n=self.n))
 
 
-    def calculate_heldout_surprisal(wordforms, n=5, smoothing=.01, num_folds=10):
-        """Calculate surprisal of words using holdout / cross-validation."""
-
-        # Make sure wordforms is np.array
-        wordforms = np.array(wordforms)
-
-        # Set up cross-validation
-        kf = KFold(n_splits=num_folds)
-        splits = list(kf.split(wordforms))
-
-        held_out_data = []
-
-        for train_indices, test_indices in tqdm(splits):
-            train = wordforms[train_indices]
-            test = wordforms[test_indices]
-
-            # Set up model
-            lm = NgramModel(n, wordforms, 1)
-            lm.create_model(train, smoothing)
+    def calculate_heldout_surprisal(self, wordforms, n=5, smoothing=.01, num_folds=10):
+        """Calculate surprisal of words using holdout / cross-validation.
 
-            for i in test:
-                held_out_data.append({
-                    'word': i,
-                    'heldout_surprisal': -lm.evaluate(i)[-1],
-                    'heldout_log_prob': lm.evaluate(i)[-1]
-                })
-        
-        return pd.DataFrame(held_out_data)
+        See calculate_heldout_surprisal_parallel; this runs the folds in this process.
+        """
+        df_heldout = calculate_heldout_surprisal_parallel({self.language: wordforms}, n=n, smoothing=smoothing,
+                                                          num_folds=num_folds, max_workers=1)
+        return df_heldout[['word', 'heldout_surprisal', 'heldout_log_prob']]
 
 
 
@@ -256,11 +296,12 @@ class Preprocessor(object):
         unique_wordforms = list(self.df_processed[self.phon_column])
         model = self.create_model(unique_wordforms, n=self.n, smoothing=self.smoothing)
 
-        # Obtain surprisal estimates
-        self.df_processed['log_prob'] = self.df_processed[self.phon_column].apply(lambda x: model.evaluate(x)[2])
-        self.df_processed['surprisal'] = self.df_processed['log_prob'].apply(lambda x: -x)
-        self.df_preprocessed['log_prob'] = self.df_preprocessed[self.phon_column].apply(lambda x: model.evaluate(x)[2])
-        self.df_preprocessed['surprisal'] = self.df_preprocessed['log_prob'].apply(lambda x: -x)
+        # Obtain surprisal estimates (each distinct wordform is scored once)
+        self.df_preprocessed['log_prob'] = model.evaluate_many(self.df_preprocessed[self.phon_column].values)[2]
+        self.df_preprocessed['surprisal'] = -self.df_preprocessed['log_prob']
+        form_log_probs = self.df_preprocessed.drop_duplicates(subset=self.phon_column).set_index(self.phon_column)['log_prob']
+        self.df_processed['log_prob'] = self.df_processed[self.phon_column].map(form_log_probs)
+        self.df_processed['surprisal'] = -self.df_processed['log_prob']
 
         # Get homophone ranks
         self.df_processed['rank_num_homophones'] = self.df_processed['num_homophones'].rank(ascending=False, method="first")
@@ -276,6 +317,8 @@ class Preprocessor(object):
         self.df_preprocessed.to_csv("data/processed/{lang1}/reals/{lang2}_all_reals_{n}phone.csv".format(lang1=self.language, lang2=self.language, n=self.n))
         print("data/processed/{lang1}/reals/{lang2}_lemmas_processed_{n}phone.csv".format(lang1=self.language, lang2=self.language, n=self.n))
         self.df_processed.to_csv("data/processed/{lang1}/reals/{lang2}_lemmas_processed_{n}phone.csv".format(lang1=self.language, lang2=self.language, n=self.n))
+        print("data/processed/{lang1}/reals/{lang2}_model_{n}phone.npz".format(lang1=self.language, lang2=self.language, n=self.n))
+        model.save("data/processed/{lang1}/reals/{lang2}_model_{n}phone.npz".format(lang1=self.language, lang2=self.language, n=self.n))
 
         return {'model': model,
                 'original_counts': original_counts,